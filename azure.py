@@ -1,52 +1,172 @@
+from __future__ import print_function
+from __future__ import division
+
+import heapq
+import itertools
 import json
+import threading
 import time
-import os
-import requests
-from cv2 import cv2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import sessions
+import cv2
 
 with open("keys.json") as f:
     j = json.load(f)
     subscription_key = j["computer_vision"]
-    server_url = j["static_url"]
-    assert server_url[-1] != "/"
 
 
-def check_images(frames):
+def encode_image(image, quality=80, max_side=1024):
+    """ jpeg encode a frame in memory
 
-    for n, image in enumerate(frames):
+    :param image: BGR frame
+    :param quality: jpeg quality (0-100)
+    :param max_side: the frame is shrunk so that its longer side has at most this many pixels
+    :return: bytes of the jpeg
+    """
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    success, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert success, "couldn't encode frame"
+    return buffer.tobytes()
 
-        start = time.time()
-        # draw = image.copy(); cv2.cvtColor(draw, cv2.COLOR_BGR2RGB)
-
-        print("frame #", n, end=" ", flush=True)
-
-        imdir, imname = "../static/arlo/azure_images", "tmp{}.jpg".format(n)
-        impath = os.path.join(imdir, imname)
-        if not os.path.exists(imdir):
-            os.makedirs(imdir)
-        cv2.imwrite(impath, image)
-        image_url = server_url + "/arlo/azure_images/" + imname
-
-        vision_base_url = "https://westeurope.api.cognitive.microsoft.com/vision/v1.0/"
-        vision_analyze_url = vision_base_url + "analyze"
-        headers = {'Ocp-Apim-Subscription-Key': subscription_key}
-        params = {'visualFeatures': 'Tags'}  # 'Categories,Description,Color'}
-        data = {'url': image_url}
+
+class TokenBucket(object):
+    """ rate limit shared by all threads talking to the Computer Vision API
+
+    Holds up to burst tokens that are refilled at rate tokens per second, every request takes one.
+    After the API answered 429, nobody gets a token until the time given in its Retry-After header.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, cancelled=None):
+        """ block until a request may be sent
+
+        :param cancelled: optional function, if it returns True while waiting no token is taken
+        :return: True if a token was taken, False if cancelled
+        """
         while True:
-            response = requests.post(vision_analyze_url, headers=headers, params=params, json=data)
-            print(response.content)
-            if response.status_code == 429:
-                print("exceeded Azure Limit, sleep for 60s")
-                time.sleep(60)
-                continue
-            break
-
-        analysis = response.json()
+            if cancelled is not None and cancelled():
+                return False
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ hand out no tokens for the next seconds """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0
+
+
+# the free tier allows 20 calls per minute, set "computer_vision_rate" (calls per second) in keys.json for others
+bucket = TokenBucket(j.get("computer_vision_rate", 20 / 60), j.get("computer_vision_burst", 1))
+_pool = ThreadPoolExecutor(max_workers=8)
+
+
+def analyze(data, cancelled=None):
+    """ request the tags of an encoded image, waiting for the rate limit
+
+    :param data: jpeg bytes
+    :param cancelled: optional function, if it returns True before the request is sent it isn't sent at all
+    :return: analysis as returned by the API, None if cancelled
+    """
+    vision_base_url = "https://westeurope.api.cognitive.microsoft.com/vision/v1.0/"
+    vision_analyze_url = vision_base_url + "analyze"
+    headers = {'Ocp-Apim-Subscription-Key': subscription_key, 'Content-Type': 'application/octet-stream'}
+    params = {'visualFeatures': 'Tags'}  # 'Categories,Description,Color'}
+    while True:
+        if not bucket.acquire(cancelled):
+            return None
+        response = sessions.get_session().post(vision_analyze_url, headers=headers, params=params, data=data)
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("Retry-After", 60))
+            except ValueError:  # an http date instead of seconds
+                retry_after = 60
+            print("exceeded Azure Limit, pausing requests for", retry_after, "s")
+            bucket.pause(retry_after)
+            continue
         response.raise_for_status()
-        # print("got:", analysis)
-        print("processing time: ", time.time() - start)
+        return response.json()
+
+
+def has_person(analysis, min_confidence=0.6):
+    for tag in analysis["tags"]:
+        if tag["name"] == "person" and tag["confidence"] > min_confidence:
+            return True
+    return False
+
+
+def check_images(frames, quality=80, max_side=1024, batch_size=3, lookahead=9):
+    """ find a frame Azure Computer Vision tags with a person
+
+    The frames are uploaded as jpeg in the request body, nothing is written to disk.
+    Up to lookahead frames are read ahead, the ones that differ most from their predecessor (they most likely
+    show somebody moving) are sent first, batch_size of them at the same time. Reading ahead costs laziness:
+    the first request waits until lookahead frames are decoded and frames after the one with a person may be
+    decoded for nothing, with lookahead equal to batch_size the frames are only ordered within every batch.
+    As soon as a frame is tagged with a person it is returned without waiting for the rest. Frames still
+    waiting for the rate limit are dropped without using it up, requests that were already sent complete.
+
+    :param frames: iterable of frames, e.g. the lazy generator of getFrames, it isn't consumed further than needed
+    :param quality: jpeg quality of the uploaded frames
+    :param max_side: longer side in pixels the uploaded frames are shrunk to
+    :param batch_size: number of frames classified at the same time
+    :param lookahead: number of frames the most promising ones are picked from, at least batch_size
+    :return: a frame with a person or None
+    """
+    found = threading.Event()
+
+    def classify(n, image):
+        if found.is_set():
+            return False
+        start = time.time()
+        analysis = analyze(encode_image(image, quality=quality, max_side=max_side), cancelled=found.is_set)
+        if analysis is None:  # a person was found on another frame meanwhile
+            return False
+        print("frame #", n, [tag["name"] for tag in analysis["tags"]], "processing time: ", time.time() - start)
+        return has_person(analysis)
+
+    numbered = enumerate(frames)
+    lookahead = max(lookahead, batch_size)
+    previous = None
+    window = []  # heap of (-motion, n, frame), the frame with the most motion first
+    try:
+        while True:
+            for n, image in itertools.islice(numbered, lookahead - len(window)):
+                thumbnail = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (64, 36)).astype(np.int16)
+                motion = 0 if previous is None else np.mean(np.abs(thumbnail - previous))
+                previous = thumbnail
+                heapq.heappush(window, (-motion, n, image))
+            if not window:
+                return None
 
-        for tag in analysis["tags"]:
-            if tag["name"] == "person" and tag["confidence"] > 0.6:
-                return image
-    return None
+            batch = [heapq.heappop(window) for _ in range(min(batch_size, len(window)))]
+            futures = {_pool.submit(classify, n_, image_): image_ for _, n_, image_ in batch}
+            try:
+                for future in as_completed(futures):
+                    if future.result():
+                        return futures[future]
+            finally:
+                # frames that haven't been sent yet aren't needed anymore
+                for future in futures:
+                    future.cancel()
+    finally:
+        # requests of this clip still waiting for the rate limit give up
+        found.set()
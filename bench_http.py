@@ -0,0 +1,84 @@
+""" compare the latency of bare requests.post calls with calls through the pooled session of sessions.py
+
+A local stub server answers every POST with a small json body, like Azure or FCM would.
+The stub talks plain HTTP, so the measured saving is the TCP handshake only, against the real
+HTTPS endpoints every pooled request additionally saves a TLS handshake.
+
+usage: python bench_http.py [--requests 200] [--delay 0.002]
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import json
+import threading
+import time
+import requests
+import numpy as np
+
+import sessions
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(delay):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # needed for keep-alive
+        disable_nagle_algorithm = True  # headers and body are written separately, don't wait for delayed ACKs
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay)
+            body = json.dumps({"tags": [{"name": "person", "confidence": 0.1}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def measure(post, url, n):
+    latencies = []
+    for _ in range(n):
+        start = time.time()
+        r = post(url, json={"url": "http://example.com/image.jpg"})
+        r.raise_for_status()
+        latencies.append(time.time() - start)
+    return np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", help="requests per variant", type=int, default=200)
+    parser.add_argument("--delay", help="seconds the stub server takes per request", type=float, default=0.002)
+    args = parser.parse_args()
+
+    server = ThreadingServer(("127.0.0.1", 0), make_handler(args.delay))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/vision/v1.0/analyze".format(server.server_address[1])
+
+    for name, post in [("requests.post", requests.post), ("pooled session", sessions.create_session().post)]:
+        ms = measure(post, url, args.requests)
+        print("{:15s} mean {:6.2f}ms  median {:6.2f}ms  p95 {:6.2f}ms".format(
+            name, ms.mean(), np.median(ms), np.percentile(ms, 95)))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+""" compare detect.non_max_suppression_fast with detect.non_max_suppression_slow
+
+Boxes are drawn around a few random people like the HOG detector (winStride=(4, 4), scale=1.05) reports them:
+many heavily overlapping boxes per person. Both functions must return the same boxes.
+
+usage: python bench_nms.py [--boxes 50 200 500] [--repeat 5]
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import time
+import numpy as np
+
+import detect
+
+
+def hog_like_boxes(n, people=5, width=400, height=300, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randint(50, [width - 50, height - 80], size=(people, 2))
+    center = centers[rng.randint(0, people, n)] + rng.randint(-12, 13, (n, 2))
+    size = rng.randint(40, 80, n)
+    boxes = np.stack([center[:, 0] - size // 2, center[:, 1] - size,
+                      center[:, 0] + size // 2, center[:, 1] + size], axis=1)
+    return boxes
+
+
+def measure(function, boxes, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        result = function(boxes, 0.65)
+    return (time.time() - start) / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--boxes", help="numbers of raw boxes per frame", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument("--repeat", help="runs per measurement", type=int, default=5)
+    args = parser.parse_args()
+
+    for n in args.boxes:
+        boxes = hog_like_boxes(n)
+        slow_ms, slow = measure(detect.non_max_suppression_slow, boxes, args.repeat)
+        fast_ms, fast = measure(detect.non_max_suppression_fast, boxes, args.repeat)
+        assert np.array_equal(slow, fast), "fast and slow nms picked different boxes"
+        print("{:4d} boxes -> {:3d} picked: slow {:8.2f}ms  fast {:6.2f}ms  ({:.0f}x)".format(
+            n, len(fast), slow_ms, fast_ms, slow_ms / fast_ms))
+
+
+if __name__ == "__main__":
+    main()
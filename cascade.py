@@ -0,0 +1,238 @@
+from __future__ import print_function
+from __future__ import division
+
+import os
+import threading
+
+import detect
+import metrics
+
+
+def _camera_configs(cameras):
+    configs = {}
+    for camera, config in (cameras or {}).items():
+        config = dict(config)
+        if "mask" in config:
+            config["mask"] = detect.loadMask(config["mask"])
+        configs[camera] = config
+    return configs
+
+
+def _camera_config(configs, camera):
+    return configs.get(camera, configs.get("default", {}))
+
+
+class MotionGate(object):
+    """ passes a frame on if it shows a tall moving blob compared to the frame before it (detect.getSuspiciousFrames)
+
+    The first frame of a clip has no predecessor and is not passed on.
+    Each camera can have its own settings, e.g. {"48B45A75EC0D3": {"levels": 2, "mask": "masks/pool.png"}}:
+    "levels" halves the resolution the motion is analyzed at that many times, "mask" is an image whose black
+    pixels are ignored (trees, the road), "threshold" overrides the grey value threshold.
+    Settings under "default" apply to all cameras without own settings.
+    """
+    name = "motion"
+
+    def __init__(self, threshold=20, cameras=None):
+        self.threshold = threshold
+        self.cameras = _camera_configs(cameras)
+
+    def __call__(self, frames, camera=None):
+        config = _camera_config(self.cameras, camera)
+        levels = config.get("levels", 0)
+        previous = None
+        for frame in frames:
+            # every frame is converted to grey scale and shrunk only once and compared to its predecessor
+            gray = detect.workingGray(frame, levels)
+            if previous is not None:
+                # the mask is resized to the working resolution once, not for every frame
+                mask = detect.fitMask(config.get("mask"), gray.shape)
+                suspicious = detect.getSuspiciousFrames([previous, gray], config.get("threshold", self.threshold),
+                                                        levels=levels, mask=mask)
+                yield frame, suspicious == [0]
+            previous = gray
+
+
+class BackgroundGate(object):
+    """ passes a frame on if it shows a tall moving blob compared to the camera's background (detect.BackgroundModel)
+
+    Every camera has its own model, it is saved to directory/<deviceId>.npy after every clip so it doesn't
+    have to be learned again after a restart. Takes the same per camera settings as MotionGate.
+    """
+    name = "background"
+
+    def __init__(self, threshold=20, cameras=None, directory="state/background"):
+        self.threshold = threshold
+        self.cameras = _camera_configs(cameras)
+        self.directory = directory
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def model(self, camera):
+        with self._lock:
+            if camera not in self._models:
+                path = os.path.join(self.directory, "{}.npy".format(camera))
+                self._models[camera] = detect.BackgroundModel(path)
+            return self._models[camera]
+
+    def __call__(self, frames, camera=None):
+        config = _camera_config(self.cameras, camera)
+        levels = config.get("levels", 0)
+        model = self.model(camera)
+        try:
+            for frame in frames:
+                gray = detect.workingGray(frame, levels)
+                mask = detect.fitMask(config.get("mask"), gray.shape)
+                with model.lock:
+                    suspicious = model.getSuspicious(gray, config.get("threshold", self.threshold), levels=levels,
+                                                     mask=mask)
+                yield frame, suspicious
+        finally:
+            with model.lock:
+                model.save()
+
+
+class HogGate(object):
+    """ passes a frame on if the HOG people detector finds somebody on it
+
+    The profile (detect.HOG_PROFILES) trades recall for speed, a gate can often afford a faster one
+    than a classifier.
+    """
+    name = "hog"
+
+    def __init__(self, overlap_threshold=0.65, profile="accurate"):
+        self.overlap_threshold = overlap_threshold
+        self.profile = profile
+
+    def __call__(self, frames, camera=None):
+        for frame in frames:
+            _, _, pick = detect.hogPeople(frame, None, self.overlap_threshold, self.profile)
+            yield frame, len(pick) > 0
+
+
+class Cascade(object):
+    """ chain of cheap gates in front of an expensive person classifier
+
+    Every gate only hands the frames it accepts to the next one, the classifier only sees the frames
+    that passed all gates. Frames are pulled through lazily, so when the classifier stops at the first
+    person no further frames are decoded or gated.
+    The share of frames every stage lets through is recorded in metrics ("cascade <stage>").
+    """
+
+    def __init__(self, gates, classifier, name="classifier", previous=False):
+        """
+        :param gates: list of gates, callables that map an iterable of frames and the camera's deviceId
+                      to (frame, accepted) tuples
+        :param classifier: function(iterable of frames, camera's deviceId) -> None or (frame with a person to be
+                           sent in the notification, that frame as it was read, (N, 4) array of the persons'
+                           [x1, y1, x2, y2] in its coordinates or None if the classifier doesn't locate persons)
+        :param name: name of the classifier in the metrics
+        :param previous: hand the classifier (frame, frame decoded before it or None) pairs instead of frames,
+                         the frame before it in the video, not the one before it that passed the gates
+        """
+        self.gates = gates
+        self.classifier = classifier
+        self.name = name
+        self.previous = previous
+
+    def __call__(self, frames, camera=None):
+        """
+        :param frames: iterable of frames
+        :param camera: deviceId of the camera that recorded the frames
+        :return: None or (frame with a person, frame as it was read, boxes of the persons), see __init__
+        """
+        if self.previous:
+            decoded = []
+            frames = self._remember(frames, decoded)
+        for gate in self.gates:
+            frames = self._filter(gate(frames, camera), metrics.get("cascade " + gate.name, unit=""))
+        frames = self._count(frames, metrics.get("cascade " + self.name + " frames", unit=""))
+        if self.previous:
+            frames = self._pair(frames, decoded)
+        try:
+            return self.classifier(frames, camera)
+        finally:
+            frames.close()
+
+    @staticmethod
+    def _filter(judged, stats):
+        for frame, accepted in judged:
+            stats.add(1. if accepted else 0.)
+            if accepted:
+                yield frame
+
+    @staticmethod
+    def _remember(frames, decoded):
+        # gates pass a frame on before they read the next one, so only the newest pair has to be kept
+        previous = None
+        for frame in frames:
+            decoded[:] = [(frame, previous)]
+            yield frame
+            previous = frame
+
+    @staticmethod
+    def _pair(frames, decoded):
+        for frame in frames:
+            assert decoded[0][0] is frame, "a gate read ahead"
+            yield decoded[0]
+
+    @staticmethod
+    def _count(frames, stats):
+        n = 0
+        try:
+            for frame in frames:
+                n += 1
+                yield frame
+        finally:
+            stats.add(n)
+
+
+def create_cascade(names, threshold=20, cameras=None, state_dir="state", hog_profile="accurate", **classifier_kwargs):
+    """ build a cascade from a list of stage names
+
+    :param names: e.g. ["motion", "hog", "azure"], all but the last one are gates ("motion", "background", "hog"),
+                  the last one is the classifier ("azure", "retinanet" or "hog")
+    :param threshold: grey value change considered a 'change' by the motion gate
+    :param cameras: per camera settings of the motion and background gates and of the regions the retinanet
+                    classifier looks at in roi mode, see MotionGate
+    :param state_dir: directory the background gate keeps its models in
+    :param hog_profile: detect.HOG_PROFILES entry of the hog gate
+    :param classifier_kwargs: passed on to the classifier
+    :return: Cascade
+    """
+    gates = []
+    for name in names[:-1]:
+        if name == "motion":
+            gates.append(MotionGate(threshold, cameras))
+        elif name == "background":
+            gates.append(BackgroundGate(threshold, cameras, os.path.join(state_dir, "background")))
+        elif name == "hog":
+            gates.append(HogGate(profile=hog_profile))
+        else:
+            raise ValueError("unknown gate: " + name)
+
+    # roi mode compares every frame with the one decoded before it, not with the one before it that passed
+    previous = names[-1] == "retinanet" and classifier_kwargs.get("mode") == "roi"
+    if names[-1] == "azure":
+        import azure
+
+        def classify(frames, camera):
+            # azure only tags a frame with "person", it doesn't tell where they are
+            frame = azure.check_images(frames, **classifier_kwargs)
+            return None if frame is None else (frame, frame, None)
+    elif names[-1] == "retinanet":
+        import fasterrcnn
+        configs = _camera_configs(cameras)
+
+        def classify(frames, camera):
+            # roi mode finds the changed regions like the motion gate, inside the camera's mask
+            config = _camera_config(configs, camera)
+            motion = dict((key, config[key]) for key in ("levels", "mask") if key in config)
+            motion["threshold"] = config.get("threshold", threshold)
+            return fasterrcnn.check_images(frames, motion=motion, with_boxes=True, **classifier_kwargs)
+    elif names[-1] == "hog":
+        def classify(frames, camera):
+            return detect.hogDetector(frames, with_boxes=True, **classifier_kwargs)
+    else:
+        raise ValueError("unknown classifier: " + names[-1])
+    return Cascade(gates, classify, names[-1], previous)
@@ -1,16 +1,150 @@
+import itertools
+import os
+import threading
 from scipy import ndimage
 import numpy as np
 import cv2
 
 
-def getSuspiciousFrames(frames, threshold=20, gui=False):
+def workingGray(frame, levels=0):
+    """ grey scale version of a frame at the resolution the motion analysis works on
+
+    :param frame: BGR frame
+    :param levels: number of gaussian pyramid levels, every level halves width and height
+    :return: (H / 2^levels, W / 2^levels) uint8 array
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    for _ in range(levels):
+        gray = cv2.pyrDown(gray)
+    return gray
+
+
+def loadMask(path):
+    """ load a mask image, white (bright) pixels are analyzed, black ones are ignored
+
+    :return: (H, W) bool array
+    """
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    assert image is not None, "couldn't read mask " + path
+    return image > 127
+
+
+_fitted_masks = {}
+_fitted_masks_lock = threading.Lock()
+
+
+def fitMask(mask, shape):
+    """ a mask at the resolution frames are analyzed at, every mask is resized only once per resolution
+
+    :param mask: (H, W) bool array of any resolution (e.g. from loadMask) or None
+    :param shape: (height, width) of the working resolution
+    :return: (height, width) bool array, mask itself if it fits already, None if mask is None
+    """
+    if mask is None or mask.shape == tuple(shape):
+        return mask
+    key = id(mask), tuple(shape)
+    with _fitted_masks_lock:
+        if key not in _fitted_masks:
+            fitted = cv2.resize(mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+            # the mask is kept alive with its resized version, so its id isn't reused by another one
+            _fitted_masks[key] = mask, fitted.astype(bool)
+        return _fitted_masks[key][1]
+
+
+def frameDifferences(frames, threshold=20, levels=0, mask=None):
+    """ compare every frame with the one before it, all pairs in the same vectorized passes
+
+    Every frame is converted to grey scale only once, differences are signed (no uint8 wrap around).
+
+    :param frames: sequence of BGR frames (or grey frames from workingGray) of equal shape
+    :param threshold: threshold when a gray scale value change is considered different
+    :param levels: pyramid levels the BGR frames are shrunk by before they are compared, grey frames are used as is
+    :param mask: (H, W) bool array of any resolution, only pixels where it is True are compared
+    :return: dict with arrays, the first axis of all but "gray" is the pair of frame n and n + 1:
+             "gray": (N, H, W) uint8 grey values of all frames,
+             "difference": (N-1, H, W) int16 change of the grey value from one frame to the next,
+             "mean_illumination_change": (N-1,) mean of each difference (inside the mask),
+             "pixels_changed": (N-1, H, W) bool, True where the change exceeds threshold in either direction
+    """
+    gray = np.stack([workingGray(frame, levels) if frame.ndim == 3 else frame for frame in frames])
+
+    difference = np.subtract(gray[1:], gray[:-1], dtype=np.int16)
+    pixels_changed = np.abs(difference) > threshold
+    if mask is None:
+        mean_illumination_change = difference.mean(axis=(1, 2))
+    else:
+        mask = fitMask(mask, gray.shape[1:])
+        pixels_changed &= mask
+        mean_illumination_change = difference[:, mask].mean(axis=1)
+    return {
+        "gray": gray,
+        "difference": difference,
+        "mean_illumination_change": mean_illumination_change,
+        "pixels_changed": pixels_changed,
+    }
+
+
+def biggestArea(pixels_changed, with_filter=False):
+    """ find the biggest continuous area of changed pixels
+
+    :param pixels_changed: (H, W) bool array
+    :param with_filter: also return the mask of the area
+    :return: (pixel count, y span, x span, (H, W) bool mask of the area if with_filter else None)
+    """
+    # label each continuous area in image
+    # retrieve the x and y span of the area that contains the most continuous pixels
+    labelled = ndimage.label(pixels_changed)
+    if not labelled[1]:
+        return 0, 0, 0, None
+    # pixel count of every area in one pass over the image (index 0 counts the unchanged pixels)
+    area_counts = np.bincount(labelled[0].ravel())[1:]
+    biggest_area = int(np.argmax(area_counts)) + 1  # the first of equally big areas
+    y_slice, x_slice = ndimage.find_objects(labelled[0], max_label=biggest_area)[-1]
+    biggest_area_filter = labelled[0] == biggest_area if with_filter else None
+    return (area_counts[biggest_area - 1], y_slice.stop - 1 - y_slice.start, x_slice.stop - 1 - x_slice.start,
+            biggest_area_filter)
+
+
+def changedAreas(frames, threshold=20, levels=0, mask=None, min_area=1000):
+    """ bounding boxes of the continuous areas that changed from one frame to the next
+
+    :param frames: two BGR frames (or grey frames from workingGray) of equal shape
+    :param threshold: threshold when a gray scale value change is considered different
+    :param levels: pyramid levels the BGR frames are shrunk by before they are compared
+    :param mask: (H, W) bool array of any resolution, only pixels where it is True are compared
+    :param min_area: minimum pixel count of an area at full resolution
+    :return: (N, 4) int array of [x1, y1, x2, y2] (x2, y2 exclusive) in full resolution coordinates
+    """
+    pixels_changed = frameDifferences(frames, threshold, levels, mask)["pixels_changed"][0]
+    labelled, count = ndimage.label(pixels_changed)
+    if not count:
+        return np.zeros((0, 4), dtype=int)
+    area_counts = np.bincount(labelled.ravel())[1:]
+    boxes = np.array([[x_slice.start, y_slice.start, x_slice.stop, y_slice.stop]
+                      for y_slice, x_slice in ndimage.find_objects(labelled)])
+    return boxes[area_counts >= min_area / 4 ** levels] * 2 ** levels
+
+
+def isSuspicious(mean_illumination_change, biggest_area_count, y_span, x_span, threshold, min_area):
+    """ only if the was no overall change in lightness and the biggest continuous area is
+    bigger than min_area pixels and taller than wide this counts a suspicous frame
+    """
+    return bool(abs(mean_illumination_change) < threshold and y_span > x_span and biggest_area_count > min_area)
+
+
+def getSuspiciousFrames(frames, threshold=20, gui=False, levels=0, mask=None, min_area=1000):
     """ detect persons on frames
 
     :param frames: numpy array with frames
     :param threshold: threshold when a gray scale value change is considered different
     :param gui: bool, True if plots are shown
-    :return:
+    :param levels: the frames are analyzed at 1 / 2^levels of their resolution (see frameDifferences)
+    :param mask: (H, W) bool array, only changes where it is True are considered
+    :param min_area: pixels a moving area must have at full resolution, scaled down with the levels
+    :return: indices n of the frames that differ suspiciously from frame n + 1
     """
+    if len(frames) < 2:
+        return []
     if gui:
         import matplotlib.pyplot as plt
         import matplotlib.gridspec as gridspec
@@ -19,36 +153,16 @@ def getSuspiciousFrames(frames, threshold=20, gui=False):
         gs1.update(wspace=0.025, hspace=0.05)
         # set the spacing between axes.
 
+    differences = frameDifferences(frames, threshold, levels, mask)
+    min_working_area = min_area / 4 ** levels
     suspicous_frames = []
     for cur_frame_id in range(len(frames) - 1):
-        a, b = cv2.cvtColor(frames[cur_frame_id], cv2.COLOR_BGR2GRAY), cv2.cvtColor(frames[cur_frame_id+1],
-                                                                                    cv2.COLOR_BGR2GRAY)
-        frame_pixel_difference = b - a
-
-        mean_illumination_change = np.mean(np.mean(frame_pixel_difference))
-        pixels_lighter = b - a > threshold
-        pixels_darker = a - b > threshold
-        pixels_changed = pixels_lighter | pixels_darker
-
-        # label each continuous area in image
-        # retrieve the x and y span of the area that contains the most continuous pixels
-        labelled = ndimage.label(pixels_changed)
-        biggest_area_count = 0
-        biggest_area_filter = None
-        for l in range(1, labelled[1] + 1):
-            pixels_filtered = (labelled[0] == l)
-            pixels_filtered_count = np.sum(np.sum(pixels_filtered))
-            if biggest_area_count < pixels_filtered_count:
-                biggest_area_count = pixels_filtered_count
-                biggest_area_filter = pixels_filtered
-                y_indices, x_indices = np.where(pixels_filtered)
-                y_span = np.max(y_indices) - np.min(y_indices)
-                x_span = np.max(x_indices) - np.min(x_indices)
+        mean_illumination_change = differences["mean_illumination_change"][cur_frame_id]
+        biggest_area_count, y_span, x_span, biggest_area_filter = biggestArea(
+            differences["pixels_changed"][cur_frame_id], with_filter=gui)
 
         ad = ""
-        if abs(mean_illumination_change) < threshold and y_span > x_span and biggest_area_count > 1000:
-            # only if the was no overall change in lightness and the biggest continuous area is
-            # bigger than 1000 pixels and taller than wide this counts a suspicous frame
+        if isSuspicious(mean_illumination_change, biggest_area_count, y_span, x_span, threshold, min_working_area):
             suspicous_frames.append(cur_frame_id)
             ad = "*"
 
@@ -67,17 +181,18 @@ def getSuspiciousFrames(frames, threshold=20, gui=False):
             # real image of frame 'a'
             ax = fig.add_subplot(no_rows, len(frames) - 1, cur_frame_id + 1 + 0 * (len(frames) - 1))
             ax.title.set_text(str(round(float(mean_illumination_change))) + ad)
-            plt.imshow(a, cmap="gray", vmin=0, vmax=255)
+            plt.imshow(differences["gray"][cur_frame_id], cmap="gray", vmin=0, vmax=255)
 
             # difference between frame a and frame b
             fig.add_subplot(no_rows, len(frames) - 1, cur_frame_id + 1 + 1 * (len(frames) - 1))
-            cax = plt.imshow(b - a, cmap="hot", vmin=-100, vmax=100, interpolation='nearest')
+            frame_pixel_difference = differences["difference"][cur_frame_id]
+            cax = plt.imshow(frame_pixel_difference, cmap="hot", vmin=-100, vmax=100, interpolation='nearest')
             fig.colorbar(cax, orientation='horizontal', ticks=[-100, 0, 100])
 
             # binary difference between frame a and b (only if above threshold)
             fig.add_subplot(no_rows, len(frames) - 1, cur_frame_id + 1 + 2 * (len(frames) - 1))
-            plt.imshow(pixels_lighter.astype(int) - pixels_darker.astype(int), cmap='hot', vmin=-1, vmax=1,
-                       interpolation='nearest')
+            plt.imshow((frame_pixel_difference > threshold).astype(int) - (frame_pixel_difference < -threshold),
+                       cmap='hot', vmin=-1, vmax=1, interpolation='nearest')
 
             # filter out only the biggest continuous area
             axu = fig.add_subplot(no_rows, len(frames) - 1, cur_frame_id + 1 + 3 * (len(frames) - 1))
@@ -95,37 +210,125 @@ def getSuspiciousFrames(frames, threshold=20, gui=False):
     return suspicous_frames
 
 
-def hogDetector(frames_list, overlap_threshold=0.65, gui=False):
+class BackgroundModel(object):
+    """ running average of the grey values a camera sees, kept across clips and restarts
+
+    Frames are compared to the background instead of to the previous frame, so slow changes in illumination
+    are absorbed by the model and don't count as motion. Pixels that differ from the background are learned
+    ten times slower, so a person standing still doesn't become background within a few frames while a car
+    that was parked still does eventually.
+    """
+
+    def __init__(self, path=None, alpha=0.05):
+        """
+        :param path: .npy file the model is loaded from if it exists and saved to
+        :param alpha: weight of a new frame in the running average
+        """
+        self.path = path
+        self.alpha = alpha
+        self.background = None
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.background = np.load(path)
+
+    def getSuspicious(self, gray, threshold=20, levels=0, mask=None, min_area=1000):
+        """ compare a frame to the background and learn it into the model
+
+        :param gray: grey frame from workingGray(frame, levels)
+        :param threshold: threshold when a gray scale value change is considered different
+        :param levels: pyramid levels the frame was shrunk by, scales min_area
+        :param mask: (H, W) bool array of any resolution (see fitMask), only changes where it is True are considered
+        :param min_area: pixels a moving area must have at full resolution
+        :return: True if the frame shows a tall moving area
+        """
+        if self.background is None or self.background.shape != gray.shape:
+            # first frame of this camera (or its resolution changed): nothing to compare to yet
+            self.background = gray.astype(np.float32)
+            return False
+
+        difference = gray - self.background
+        pixels_changed = np.abs(difference) > threshold
+        if mask is not None:
+            mask = fitMask(mask, gray.shape)
+            pixels_changed &= mask
+            mean_illumination_change = difference[mask].mean()
+        else:
+            mean_illumination_change = difference.mean()
+        biggest_area_count, y_span, x_span, _ = biggestArea(pixels_changed)
+
+        foreground = pixels_changed.astype(np.uint8)
+        cv2.accumulateWeighted(gray, self.background, self.alpha, mask=1 - foreground)
+        cv2.accumulateWeighted(gray, self.background, self.alpha / 10, mask=foreground)
+        return isSuspicious(mean_illumination_change, biggest_area_count, y_span, x_span, threshold,
+                            min_area / 4 ** levels)
+
+    def save(self):
+        """ write the model to its path, replacing the old file only once the new one is complete """
+        if self.path is None or self.background is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + ".tmp.npy"
+        np.save(tmp_path, self.background)
+        os.replace(tmp_path, self.path)
+
+
+# detectMultiScale settings, from most accurate to fastest
+# width: frames are shrunk to this width first, winStride: step of the detection window,
+# scale: factor between the image pyramid levels
+HOG_PROFILES = {
+    "accurate": dict(width=400, winStride=(4, 4), padding=(8, 8), scale=1.05),
+    "balanced": dict(width=320, winStride=(8, 8), padding=(8, 8), scale=1.1),
+    "fast": dict(width=256, winStride=(8, 8), padding=(0, 0), scale=1.2),
+}
+
+_hog_local = threading.local()
+_hog_pools = {}
+_hog_pools_lock = threading.Lock()
+
+
+def getHog():
+    """ the HOG people detector of the calling thread, it is created only once per thread """
+    if not hasattr(_hog_local, "hog"):
+        _hog_local.hog = cv2.HOGDescriptor()
+        _hog_local.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    return _hog_local.hog
+
+
+def _getHogPool(workers):
+    with _hog_pools_lock:
+        if workers not in _hog_pools:
+            from concurrent.futures import ThreadPoolExecutor
+            _hog_pools[workers] = ThreadPoolExecutor(workers)
+        return _hog_pools[workers]
+
+
+def hogDetector(frames_list, overlap_threshold=0.65, gui=False, profile="accurate", workers=1, with_boxes=False):
     """
-    :param frames_list:
+    :param frames_list: iterable of frames, e.g. the lazy generator of getFrames, it isn't consumed further than needed
     :param overlap_threshold: parameter for non maximum supression
     :param gui: visual output of detected image
-    :return: the first detected frame (with bounding boxes inside)
+    :param profile: name of the detectMultiScale settings in HOG_PROFILES
+    :param workers: number of frames detected on in parallel (OpenCV releases the GIL while detecting), with more
+                    than one worker up to workers - 1 frames after the detected one are read from frames_list
+    :param with_boxes: also return the frame as it was read and the persons' boxes
+    :return: the first detected frame (with bounding boxes inside), if with_boxes (that frame, the frame as it was
+             read, (N, 4) array of the persons' [x1, y1, x2, y2] in coordinates of the read frame)
     """
-    hog = cv2.HOGDescriptor()
-    hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+    def detect(frame):
+        return (frame,) + tuple(hogPeople(frame, None, overlap_threshold, profile))
+
+    if workers > 1:
+        pool = _getHogPool(workers)
+        frames = iter(frames_list)
+        chunks = iter(lambda: list(itertools.islice(frames, workers)), [])
+        results = itertools.chain.from_iterable(pool.map(detect, chunk) for chunk in chunks)
+    else:
+        results = (detect(frame) for frame in frames_list)
 
     # loop over the image paths
-    for no, image in enumerate(frames_list):
-        # load the image and resize it to (1) reduce detection time
-        # and (2) improve detection accuracy
-        # image = frames[frame_id, :, :].reshape(height, width)
-        image = resize(image, width=min(400, image.shape[1]))
-
-        # detect people in the image
-        (rects, weights) = hog.detectMultiScale(image, winStride=(4, 4), padding=(8, 8), scale=1.05)
-
-        # draw the original bounding boxes
-        # orig = image.copy()
-        # for (x, y, w, h) in rects:
-        #     cv2.rectangle(orig, (x, y), (x + w, y + h), (0, 0, 255), 2)
-
-        # apply non-maxima suppression to the bounding boxes using a
-        # fairly large overlap threshold to try to maintain overlapping
-        # boxes that are still people
-        rects = np.array([[x, y, x + w, y + h] for (x, y, w, h) in rects])
-        # pick = imutils.object_detection.non_max_suppression(rects, probs=None, overlapThresh=0.65)
-        pick = non_max_suppression_slow(rects, overlapThresh=overlap_threshold)
+    for frame, image, rects, pick in results:
         if len(pick) == 0:
             continue
 
@@ -144,10 +347,50 @@ def hogDetector(frames_list, overlap_threshold=0.65, gui=False):
             plt.imshow(image)
             plt.show()
 
+        if with_boxes:
+            # hogPeople detects on a shrunk copy of the frame
+            return image, frame, np.asarray(pick, dtype=float) * frame.shape[1] / image.shape[1]
         return image
     return None
 
 
+def hogPeople(image, hog=None, overlap_threshold=0.65, profile="accurate"):
+    """ detect people on a single frame
+
+    :param image: BGR frame
+    :param hog: cv2.HOGDescriptor with the people detector set, None for the one of the calling thread (getHog)
+    :param overlap_threshold: parameter for non maximum supression
+    :param profile: name of the detectMultiScale settings in HOG_PROFILES
+    :return: (the resized frame the detection ran on, all detected boxes, boxes after non maximum suppression),
+             boxes are [x1, y1, x2, y2] in coordinates of the resized frame
+    """
+    settings = dict(HOG_PROFILES[profile])
+    width = settings.pop("width")
+    if hog is None:
+        hog = getHog()
+
+    # load the image and resize it to (1) reduce detection time
+    # and (2) improve detection accuracy
+    # image = frames[frame_id, :, :].reshape(height, width)
+    image = resize(image, width=min(width, image.shape[1]))
+
+    # detect people in the image
+    (rects, weights) = hog.detectMultiScale(image, **settings)
+
+    # draw the original bounding boxes
+    # orig = image.copy()
+    # for (x, y, w, h) in rects:
+    #     cv2.rectangle(orig, (x, y), (x + w, y + h), (0, 0, 255), 2)
+
+    # apply non-maxima suppression to the bounding boxes using a
+    # fairly large overlap threshold to try to maintain overlapping
+    # boxes that are still people
+    rects = np.array([[x, y, x + w, y + h] for (x, y, w, h) in rects])
+    # pick = imutils.object_detection.non_max_suppression(rects, probs=None, overlapThresh=0.65)
+    pick = non_max_suppression_fast(rects, overlapThresh=overlap_threshold)
+    return image, rects, pick
+
+
 def non_max_suppression_slow(boxes, overlapThresh):
     # if there are no boxes, return an empty list
     if len(boxes) == 0:
@@ -213,6 +456,60 @@ def non_max_suppression_slow(boxes, overlapThresh):
     return boxes[pick]
 
 
+def non_max_suppression_fast(boxes, overlapThresh, scores=None):
+    """ non maximum suppression, picks the same boxes in the same order as non_max_suppression_slow
+
+    Instead of comparing the picked box with every remaining box in a python loop, all overlaps
+    with the remaining boxes are computed in one vectorized step, so the loop only runs once per picked box.
+
+    :param boxes: (N, 4) array of [x1, y1, x2, y2], further columns (e.g. scores) are returned along
+    :param overlapThresh: boxes that overlap a picked box by more than this share of their own area are suppressed
+    :param scores: optional (N,) array, boxes with higher scores are picked first
+                   (by default the boxes lowest in the image are picked first)
+    :return: the picked boxes
+    """
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return []
+
+    x1 = boxes[:, 0]
+    y1 = boxes[:, 1]
+    x2 = boxes[:, 2]
+    y2 = boxes[:, 3]
+
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = np.argsort(y2 if scores is None else scores)
+
+    pick = []
+    while len(idxs) > 0:
+        # pick the last index, compute its overlap with all remaining boxes at once
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+        others = idxs[:last]
+
+        w = np.maximum(0, np.minimum(x2[i], x2[others]) - np.maximum(x1[i], x1[others]) + 1)
+        h = np.maximum(0, np.minimum(y2[i], y2[others]) - np.maximum(y1[i], y1[others]) + 1)
+        overlap = (w * h) / area[others]
+
+        idxs = np.delete(idxs, np.concatenate(([last], np.where(overlap > overlapThresh)[0])))
+
+    return boxes[pick]
+
+
+def non_max_suppression_batch(boxes_list, overlapThresh, scores_list=None):
+    """ non_max_suppression_fast for the boxes of several frames
+
+    :param boxes_list: list with an (N_i, 4) array of boxes per frame
+    :param overlapThresh: see non_max_suppression_fast
+    :param scores_list: optional list with an (N_i,) array of scores per frame
+    :return: list with the picked boxes per frame
+    """
+    if scores_list is None:
+        scores_list = [None] * len(boxes_list)
+    return [non_max_suppression_fast(boxes, overlapThresh, scores) for boxes, scores in zip(boxes_list, scores_list)]
+
+
 def resize(image, width=None, height=None, inter=cv2.INTER_AREA):
     # initialize the dimensions of the image to be resized and
     # grab the image size
@@ -1,17 +1,18 @@
 from __future__ import print_function
 from __future__ import division
 
-import keras
-
-# import keras_retinanet
-from keras_retinanet.models.resnet import custom_objects
-from keras_retinanet.utils.image import read_image_bgr, preprocess_image, resize_image
+# import keras_retinanet, keras itself is only imported to load .h5 snapshots, see RetinaNetDetector
+from keras_retinanet.utils.frozen_graph import FrozenGraphModel, RESOLUTION_PROFILES
+from keras_retinanet.utils.frozen_graph import preprocess_image, resize_image, pad_images
 from keras_retinanet.utils.visualization import draw_box, draw_caption
 from keras_retinanet.utils.colors import label_color
 
 # import miscellaneous modules
 import cv2
+import detect
+import itertools
 import os
+import threading
 import numpy as np
 import time
 
@@ -19,82 +20,320 @@ import time
 import tensorflow as tf
 
 
-def get_session():
+# adjust this to point to your downloaded/trained model
+MODEL_PATH = os.path.join('snapshots', 'resnet50_coco_best_v2.0.2.h5')
+
+PERSON = 0
+
+# label to names mapping for visualization purposes
+LABELS_TO_NAMES = {0: 'person', 1: 'bicycle', 2: 'car', 3: 'motorcycle', 4: 'airplane', 5: 'bus', 6: 'train', 7: 'truck', 8: 'boat', 9: 'traffic light', 10: 'fire hydrant', 11: 'stop sign', 12: 'parking meter', 13: 'bench', 14: 'bird', 15: 'cat', 16: 'dog', 17: 'horse', 18: 'sheep', 19: 'cow', 20: 'elephant', 21: 'bear', 22: 'zebra', 23: 'giraffe', 24: 'backpack', 25: 'umbrella', 26: 'handbag', 27: 'tie', 28: 'suitcase', 29: 'frisbee', 30: 'skis', 31: 'snowboard', 32: 'sports ball', 33: 'kite', 34: 'baseball bat', 35: 'baseball glove', 36: 'skateboard', 37: 'surfboard', 38: 'tennis racket', 39: 'bottle', 40: 'wine glass', 41: 'cup', 42: 'fork', 43: 'knife', 44: 'spoon', 45: 'bowl', 46: 'banana', 47: 'apple', 48: 'sandwich', 49: 'orange', 50: 'broccoli', 51: 'carrot', 52: 'hot dog', 53: 'pizza', 54: 'donut', 55: 'cake', 56: 'chair', 57: 'couch', 58: 'potted plant', 59: 'bed', 60: 'dining table', 61: 'toilet', 62: 'tv', 63: 'laptop', 64: 'mouse', 65: 'remote', 66: 'keyboard', 67: 'cell phone', 68: 'microwave', 69: 'oven', 70: 'toaster', 71: 'sink', 72: 'refrigerator', 73: 'book', 74: 'clock', 75: 'vase', 76: 'scissors', 77: 'teddy bear', 78: 'hair drier', 79: 'toothbrush'}
+
+
+def get_session_config():
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
-    return tf.Session(config=config)
+    return config
+
+
+def get_session():
+    return tf.Session(config=get_session_config())
+
+
+class RetinaNetDetector(object):
+    """ RetinaNet model that stays loaded for the lifetime of the process
+
+    Loading the model takes seconds, so it is done once, followed by a prediction on a dummy image
+    that lets TensorFlow allocate its memory and pick its kernels before the first clip arrives.
+    The model has its own graph and session. Predictions are serialized by a lock, the classify workers
+    of the server share one model.
+    The model is either a keras snapshot (.h5) or a frozen, possibly quantized graph (.pb) written by
+    keras_retinanet/bin/convert_model.py. Frames are shrunk to the resolution profile before detection.
+    A converted graph loads without importing keras, which starts much faster and needs less memory.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, resolution=None, classes=None, warmup=True):
+        """
+        :param model_path: keras snapshot of a RetinaNet with bounding box and nms layers or a converted graph
+        :param resolution: name of the input size in keras_retinanet.utils.frozen_graph.RESOLUTION_PROFILES,
+                           None for the one a converted graph was converted for or "full" for a keras snapshot
+        :param classes: labels NMS is run for, e.g. [0] for persons only, None for all labels of the snapshot,
+                        a converted graph keeps the labels it was converted with
+        :param warmup: run a dummy image through the model right away
+        """
+        start = time.time()
+        if not os.path.exists(model_path):
+            print("Download model from:", "https://github.com/fizyr/keras-retinanet/releases/")
+            print("cwd:", os.getcwd())
+
+        self.frozen = model_path.endswith(".pb")
+        if self.frozen:
+            self.model = FrozenGraphModel(model_path, session_config=get_session_config())
+            classes = self.model.classes
+            resolution = resolution or self.model.resolution
+        else:
+            import keras
+            from keras_retinanet.models.resnet import custom_objects
+            from keras_retinanet.models.retinanet import retinanet_bbox_subset
+
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                self.session = get_session()
+                with self.session.as_default():
+                    # load retinanet model
+                    self.model = keras.models.load_model(model_path, custom_objects=custom_objects)
+                    if classes is not None:
+                        self.model = retinanet_bbox_subset(self.model, classes)
+            if classes is None:
+                classes = range(keras.backend.int_shape(self.model.outputs[-1])[-1])
+        # label of every column of nms_classification
+        self.labels = np.array(classes)
+        self.min_side, self.max_side = RESOLUTION_PROFILES[resolution or "full"]
+        self.lock = threading.Lock()
+        print("load up time:", time.time() - start)
+
+        if warmup:
+            start = time.time()
+            self.predict([np.zeros((self.min_side, self.max_side, 3), dtype=np.float32)])
+            print("warm up time:", time.time() - start)
+
+    def prepare(self, image):
+        """
+        :param image: BGR frame
+        :return: (the frame preprocessed and resized for the network, the scale it was resized by)
+        """
+        return resize_image(preprocess_image(image), min_side=self.min_side, max_side=self.max_side)
+
+    def detect(self, frames):
+        """ find the persons on a batch of frames
+
+        :param frames: list of BGR frames
+        :return: list with (boxes, scores) of the persons on every frame, see person_detections
+        """
+        images, scales = zip(*[self.prepare(frame) for frame in frames])
+        batch_boxes, batch_classification = self.predict(list(images))
+        return [person_detections(boxes, nms_classification, self.labels, scale, image.shape)
+                for boxes, nms_classification, scale, image in zip(batch_boxes, batch_classification, scales, images)]
+
+    def detect_regions(self, frame, regions, resolution="small", overlap_threshold=0.5):
+        """ find the persons inside regions of one frame
+
+        Every region is cropped and scaled to the resolution profile on its own, so small persons in a small
+        region are enlarged instead of shrunk with the whole frame. All regions run through the network as
+        one batch. Persons found twice where regions overlap are merged by non maximum suppression.
+
+        :param frame: BGR frame
+        :param regions: (N, 4) int array of [x1, y1, x2, y2] (x2, y2 exclusive), e.g. from tile_regions
+        :param resolution: name of the input size of every region in RESOLUTION_PROFILES
+        :param overlap_threshold: boxes overlapping a higher scoring box by more than this share are dropped
+        :return: (boxes, scores) of the persons in frame coordinates, see person_detections
+        """
+        min_side, max_side = RESOLUTION_PROFILES[resolution]
+        images, scales = zip(*[resize_image(preprocess_image(frame[y1:y2, x1:x2]), min_side=min_side, max_side=max_side)
+                               for x1, y1, x2, y2 in regions])
+        batch_boxes, batch_classification = self.predict(list(images))
+
+        boxes, scores = [], []
+        for region, region_boxes, nms_classification, scale, image in zip(regions, batch_boxes, batch_classification,
+                                                                          scales, images):
+            region_boxes, region_scores = person_detections(region_boxes, nms_classification, self.labels, scale,
+                                                            image.shape)
+            boxes.append(region_boxes + np.tile(region[:2], 2))
+            scores.append(region_scores)
+        boxes, scores = np.concatenate(boxes), np.concatenate(scores)
+        if len(scores) == 0:
+            return boxes, scores
+
+        merged = detect.non_max_suppression_fast(np.column_stack([boxes, scores]), overlap_threshold, scores)
+        return merged[:, :4], merged[:, 4]
 
+    def predict(self, images):
+        """ run the network once on a batch of images
 
-def check_images(frames, gui=False):
+        :param images: list of prepared images, smaller ones are zero padded to the largest
+        :return: (boxes, nms_classification) with one entry per image, boxes are in coordinates of the resized image
+                 but only clipped to the padded batch, column i of nms_classification holds the scores of label
+                 self.labels[i]
+        """
+        batch = pad_images(images)
+        with self.lock:
+            if self.frozen:
+                _, _, boxes, nms_classification = self.model.predict_on_batch(batch)
+            else:
+                with self.graph.as_default(), self.session.as_default():
+                    _, _, boxes, nms_classification = self.model.predict_on_batch(batch)
+        return boxes, nms_classification
+
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def get_detector(model_path=MODEL_PATH, resolution=None):
+    """ the detector shared by all callers of this process that ask for the same model and resolution,
+    loaded on first use """
+    with _detectors_lock:
+        if (model_path, resolution) not in _detectors:
+            _detectors[model_path, resolution] = RetinaNetDetector(model_path, resolution, classes=[PERSON])
+        return _detectors[model_path, resolution]
+
+
+def person_detections(boxes, nms_classification, labels, scale=1, shape=None, score_threshold=0.5):
+    """ the persons among the detections of one image
+
+    :param boxes: (N, 4) boxes of the image as predicted
+    :param nms_classification: (N, C) scores of the image after non maximum suppression
+    :param labels: (C,) label of every column of nms_classification
+    :param scale: factor the image was resized by before the prediction, boxes are divided by it
+    :param shape: shape of the resized image without padding, boxes are clipped to it, None if not padded
+    :param score_threshold: minimum score of a person
+    :return: (boxes (K, 4) in frame coordinates, scores (K,)) of the boxes whose most likely label is person,
+             highest score first
+    """
+    predicted_columns = np.argmax(nms_classification, axis=1)
+    scores = nms_classification[np.arange(nms_classification.shape[0]), predicted_columns]
+    persons = np.flatnonzero((labels[predicted_columns] == PERSON) & (scores > score_threshold))
+    persons = persons[np.argsort(-scores[persons])]
+    boxes = boxes[persons]
+    if shape is not None:
+        # images of a batch are zero padded to the largest one, the model only clips to the padded size
+        boxes = np.clip(boxes, 0, [shape[1], shape[0], shape[1], shape[0]])
+    return boxes / scale, scores[persons]
+
+
+def draw_persons(frame, boxes, scores):
+    """
+    :param frame: BGR frame
+    :param boxes: person boxes in frame coordinates, see person_detections
+    :param scores: their scores
+    :return: RGB copy of the frame with the boxes and their scores drawn in
+    """
+    draw = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    color = label_color(PERSON)
+    for box, score in zip(boxes.astype(int), scores):
+        draw_box(draw, box, color=color)
+        draw_caption(draw, box, "{} {:.3f}".format(LABELS_TO_NAMES[PERSON], score))
+    return draw
+
+
+def tile_regions(shape, grid=(2, 2), overlap=0.2):
+    """ regions of equal size that cover a frame
+
+    :param shape: shape of the frame
+    :param grid: (rows, columns) of tiles
+    :param overlap: share of a tile that overlaps with its neighbours, so persons on a border are seen whole
+    :return: (rows * columns, 4) int array of [x1, y1, x2, y2] (x2, y2 exclusive)
+    """
+    regions = []
+    height, width = shape[:2]
+    tile_height = height / (grid[0] - (grid[0] - 1) * overlap)
+    tile_width = width / (grid[1] - (grid[1] - 1) * overlap)
+    for row in range(grid[0]):
+        for column in range(grid[1]):
+            y1, x1 = row * tile_height * (1 - overlap), column * tile_width * (1 - overlap)
+            regions.append([x1, y1, min(x1 + tile_width, width), min(y1 + tile_height, height)])
+    return np.round(regions).astype(int)
+
+
+def motion_regions(previous, frame, margin=0.5, min_size=160, max_regions=4, threshold=20, levels=2, mask=None,
+                   min_area=500):
+    """ regions around the areas that changed since the previous frame
+
+    :param previous: BGR frame before frame
+    :param frame: BGR frame
+    :param margin: share of the changed area's width and height added on each side, moving persons are often
+                   only partly changed
+    :param min_size: minimum width and height of a region in pixels
+    :param max_regions: only the biggest regions are returned
+    :param threshold: grey value change considered a 'change'
+    :param levels: pyramid levels the frames are shrunk by before they are compared, see detect.changedAreas
+    :param mask: (H, W) bool array, changes where it is False (trees, the road) are ignored
+    :param min_area: minimum pixel count of a changed area at full resolution
+    :return: (N, 4) int array of [x1, y1, x2, y2] (x2, y2 exclusive), N may be 0
+    """
+    height, width = frame.shape[:2]
+    areas = detect.changedAreas([previous, frame], threshold, levels=levels, mask=mask, min_area=min_area).astype(float)
+    size = areas[:, 2:] - areas[:, :2]
+    grow = np.maximum(size * margin, (min_size - size) / 2)
+    regions = np.concatenate([areas[:, :2] - grow, areas[:, 2:] + grow], axis=1)
+    regions = np.clip(regions, 0, [width, height, width, height]).round().astype(int)
+    biggest = np.argsort(-np.prod(regions[:, 2:] - regions[:, :2], axis=1))[:max_regions]
+    return regions[biggest]
+
+
+def _frame_detections(detector, frames, batch_size, mode, crop_resolution, motion):
+    """ (frame, (boxes, scores)) for every frame, see check_images for the modes """
+    if mode == "full":
+        for batch in iter(lambda: list(itertools.islice(frames, batch_size)), []):
+            start = time.time()
+            detections = detector.detect(batch)
+            print("processing time of", len(batch), "frames:", time.time() - start)
+            for frame, frame_detections in zip(batch, detections):
+                yield frame, frame_detections
+        return
+
+    previous = None
+    for frame in frames:
+        if mode == "roi":
+            # a (frame, previous decoded frame) pair from a cascade, otherwise the frame before it here
+            frame, previous = frame if isinstance(frame, tuple) else (frame, previous)
+            regions = motion_regions(previous, frame, **motion) if previous is not None else []
+            if len(regions) == 0:
+                # nothing to compare to or nothing changed: one pass over the whole frame, as cheap as a region
+                regions = np.array([[0, 0, frame.shape[1], frame.shape[0]]])
+        else:
+            regions = tile_regions(frame.shape)
+        start = time.time()
+        detections = detector.detect_regions(frame, regions, crop_resolution)
+        print("processing time of", len(regions), "regions:", time.time() - start)
+        yield frame, detections
+        previous = frame
+
+
+def check_images(frames, gui=False, batch_size=4, model_path=MODEL_PATH, resolution=None, mode="full",
+                 crop_resolution="small", motion=None, with_boxes=False):
+    """ find the first frame RetinaNet detects a person on
+
+    :param frames: iterable of frames, e.g. the lazy generator of getFrames, it isn't consumed further than needed,
+                   in roi mode also of (frame, frame decoded before it) pairs, see cascade.Cascade
+    :param gui: show every frame with its detections
+    :param batch_size: frames run through the network at once, up to batch_size - 1 frames after the first
+                       one with a person are read from frames
+    :param model_path: keras snapshot or converted graph, see RetinaNetDetector
+    :param resolution: name of the input size in keras_retinanet.utils.frozen_graph.RESOLUTION_PROFILES, see
+                       RetinaNetDetector
+    :param mode: "full": the whole frame is scaled to resolution,
+                 "tiles": overlapping tiles of the frame are scaled to crop_resolution each, this finds smaller
+                 persons but isn't cheaper: 4 "small" tiles of a 1920x1080 frame are 1.44 Mpx, "full" is 1.0 Mpx,
+                 "roi": the regions that changed since the previous decoded frame are scaled to crop_resolution
+                 each (0.36 Mpx or less per region at "small"), the whole frame is scaled to crop_resolution
+                 for the first frame and frames without changes
+    :param crop_resolution: input size of every tile or region in RESOLUTION_PROFILES
+    :param motion: the camera's "threshold", "levels" and "mask" the regions of roi mode are found with,
+                   see motion_regions and cascade.MotionGate
+    :param with_boxes: also return the frame as it was read and the persons' boxes
+    :return: the first frame with a person (RGB, with bounding boxes drawn in) or None, if with_boxes
+             (that frame, the frame as it was read, (N, 4) array of the persons' [x1, y1, x2, y2])
+    """
 
     # use this environment flag to change which GPU to use
     # os.environ["CUDA_VISIBLE_DEVICES"] = "1"
-    # set the modified tf session as backend in keras
-    start = time.time()
-    keras.backend.tensorflow_backend.set_session(get_session())
-
-    # adjust this to point to your downloaded/trained model
-    model_path = os.path.join('snapshots', 'resnet50_coco_best_v2.0.2.h5')
-    if not os.path.exists(model_path):
-        print("Download model from:", "https://github.com/fizyr/keras-retinanet/releases/")
-        print("cwd:", os.getcwd())
-    # load retinanet model
-    model = keras.models.load_model(model_path, custom_objects=custom_objects)
-    # print(model.summary())
-    print("load up time:", time.time()-start)
-
-    # load label to names mapping for visualization purposes
-    labels_to_names = {0: 'person', 1: 'bicycle', 2: 'car', 3: 'motorcycle', 4: 'airplane', 5: 'bus', 6: 'train', 7: 'truck', 8: 'boat', 9: 'traffic light', 10: 'fire hydrant', 11: 'stop sign', 12: 'parking meter', 13: 'bench', 14: 'bird', 15: 'cat', 16: 'dog', 17: 'horse', 18: 'sheep', 19: 'cow', 20: 'elephant', 21: 'bear', 22: 'zebra', 23: 'giraffe', 24: 'backpack', 25: 'umbrella', 26: 'handbag', 27: 'tie', 28: 'suitcase', 29: 'frisbee', 30: 'skis', 31: 'snowboard', 32: 'sports ball', 33: 'kite', 34: 'baseball bat', 35: 'baseball glove', 36: 'skateboard', 37: 'surfboard', 38: 'tennis racket', 39: 'bottle', 40: 'wine glass', 41: 'cup', 42: 'fork', 43: 'knife', 44: 'spoon', 45: 'bowl', 46: 'banana', 47: 'apple', 48: 'sandwich', 49: 'orange', 50: 'broccoli', 51: 'carrot', 52: 'hot dog', 53: 'pizza', 54: 'donut', 55: 'cake', 56: 'chair', 57: 'couch', 58: 'potted plant', 59: 'bed', 60: 'dining table', 61: 'toilet', 62: 'tv', 63: 'laptop', 64: 'mouse', 65: 'remote', 66: 'keyboard', 67: 'cell phone', 68: 'microwave', 69: 'oven', 70: 'toaster', 71: 'sink', 72: 'refrigerator', 73: 'book', 74: 'clock', 75: 'vase', 76: 'scissors', 77: 'teddy bear', 78: 'hair drier', 79: 'toothbrush'}
-
-    # load image
-    for n, image in enumerate(frames):
-
-        # copy to draw on
-        draw = image.copy()
-        draw = cv2.cvtColor(draw, cv2.COLOR_BGR2RGB)
-
-        # preprocess image for network
-        image = preprocess_image(image)
-        image, scale = resize_image(image)
-
-        # process image
-        start = time.time()
-        print("frame #", n, end=" ", flush=True)
-        _, _, boxes, nms_classification = model.predict_on_batch(np.expand_dims(image, axis=0))
-        print("processing time: ", time.time() - start)
-
-        # compute predicted labels and scores
-        predicted_labels = np.argmax(nms_classification[0, :, :], axis=1)
-        scores = nms_classification[0, np.arange(nms_classification.shape[1]), predicted_labels]
-
-        # correct for image scale
-        boxes /= scale
-
-        found_person = False
-        # visualize detections
-        for i in np.where(scores > 0.5)[0]:
-            label = predicted_labels[i]
-            if label != 0:
-                continue
-            found_person = True
-            score = scores[i]
-
-            color = label_color(label)
-
-            b = boxes[0, i, :].astype(int)
-            draw_box(draw, b, color=color)
-
-            caption = "{} {:.3f}".format(labels_to_names[label], score)
-            draw_caption(draw, b, caption)
-
-        if gui:
-            import matplotlib.pyplot as plt
-            plt.figure(figsize=(15, 15))
-            plt.axis('off')
-            plt.imshow(draw)
-            plt.show()
-
-        if found_person:
-            print("found a person on frame", n)
-            return draw
+    detector = get_detector(model_path, resolution)
+
+    detections = _frame_detections(detector, iter(frames), batch_size, mode, crop_resolution, motion or {})
+    try:
+        for n, (frame, (boxes, scores)) in enumerate(detections):
+            if gui:
+                import matplotlib.pyplot as plt
+                plt.figure(figsize=(15, 15))
+                plt.axis('off')
+                plt.imshow(draw_persons(frame, boxes, scores))
+                plt.show()
+
+            if len(scores) > 0:
+                print("found a person on frame", n)
+                # only the frame that is sent in the notification is drawn on
+                drawn = draw_persons(frame, boxes, scores)
+                return (drawn, frame, boxes) if with_boxes else drawn
+    finally:
+        detections.close()
     return None
@@ -48,3 +48,7 @@ def meshgrid(*args, **kwargs):
 
 def where(*args, **kwargs):
     return tensorflow.where(*args, **kwargs)
+
+
+def map_fn(*args, **kwargs):
+    return tensorflow.map_fn(*args, **kwargs)
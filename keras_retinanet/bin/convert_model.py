@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2017-2018 Fizyr (https://fizyr.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import keras
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# Allow relative imports when being executed as script.
+if __name__ == "__main__" and __package__ is None:
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+    import keras_retinanet.bin
+    __package__ = "keras_retinanet.bin"
+
+# Change these to absolute imports if you copy this script outside the keras_retinanet package.
+from ..utils.keras_version import check_keras_version
+from ..utils.eval import evaluate
+from ..utils.frozen_graph import FrozenGraphModel, RESOLUTION_PROFILES, add_metadata
+from ..models.resnet import custom_objects
+from ..models.retinanet import retinanet_bbox_subset
+from .evaluate import create_generator, get_session
+
+# graph transforms applied for every precision, they only simplify the graph
+CLEANUP_TRANSFORMS = [
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+]
+
+# float32 : frozen weights, otherwise unchanged.
+# weights8: weights stored as 8 bit and converted back to float when the graph is loaded (4x smaller file).
+# int8    : additionally computes convolutions and matrix multiplications with 8 bit integers where supported.
+PRECISION_TRANSFORMS = {
+    'float32'  : [],
+    'weights8' : ['quantize_weights'],
+    'int8'     : ['quantize_weights', 'quantize_nodes'],
+}
+
+
+def freeze(model, precision='float32', classes=None, resolution='full'):
+    """ Convert the variables of a loaded prediction model to constants and optionally quantize them.
+
+    The result is self contained: the tensor names, classes and resolution profile the graph needs at runtime
+    are stored in the graph itself (see utils.frozen_graph.FrozenGraphModel).
+
+    # Arguments
+        model      : A retinanet_bbox model, loaded in the current keras session.
+        precision  : One of PRECISION_TRANSFORMS.
+        classes    : Class index of every column of the NMS output, None if the model performs NMS for all classes.
+        resolution : Name of the resolution profile the graph is meant to run at.
+    # Returns
+        The GraphDef of the converted model.
+    """
+    session      = keras.backend.get_session()
+    input_name   = model.inputs[0].op.name
+    output_names = [output.op.name for output in model.outputs]
+
+    graph_def = graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    graph_def = graph_util.remove_training_nodes(graph_def)
+
+    transforms = CLEANUP_TRANSFORMS + PRECISION_TRANSFORMS[precision] + ['strip_unused_nodes', 'sort_by_execution_order']
+    graph_def  = TransformGraph(graph_def, [input_name], output_names, transforms)
+
+    metadata = {
+        'input'      : model.inputs[0].name,
+        'outputs'    : [output.name for output in model.outputs],
+        'classes'    : classes or list(range(keras.backend.int_shape(model.outputs[-1])[-1])),
+        'precision'  : precision,
+        'resolution' : resolution,
+    }
+    return add_metadata(graph_def, metadata)
+
+
+class AllClasses(object):
+    """ Scatters the NMS output of a class subset model back to all classes, for evaluate. """
+
+    def __init__(self, model, classes, num_classes):
+        self.model       = model
+        self.classes     = classes
+        self.num_classes = num_classes
+
+    def predict_on_batch(self, images):
+        outputs = self.model.predict_on_batch(images)
+        nms     = np.zeros(outputs[-1].shape[:2] + (self.num_classes,), dtype=outputs[-1].dtype)
+        nms[..., self.classes] = outputs[-1]
+        return list(outputs[:-1]) + [nms]
+
+
+def measure_latency(model, resolution, repeat):
+    """ Mean time in seconds of predicting a single image of the largest size a resolution profile produces. """
+    image = np.zeros((1,) + resolution + (3,), dtype=keras.backend.floatx())
+    model.predict_on_batch(image)
+    start = time.time()
+    for _ in range(repeat):
+        model.predict_on_batch(image)
+    return (time.time() - start) / repeat
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Convert a RetinaNet snapshot to a frozen, optionally quantized inference graph.')
+
+    parser.add_argument('model',             help='Path to RetinaNet snapshot (with bbox and NMS layers).')
+    parser.add_argument('output',            help='Path of the frozen graph (.pb).')
+    parser.add_argument('--precision',       help='Precision of the converted graph (defaults to float32).', choices=sorted(PRECISION_TRANSFORMS), default='float32')
+    parser.add_argument('--nms-classes',     help='Only perform NMS for these class indices (e.g. 0 for persons).', type=int, nargs='+')
+    parser.add_argument('--resolution',      help='Resolution profile the graph is run at by default (defaults to full).', choices=sorted(RESOLUTION_PROFILES), default='full')
+    parser.add_argument('--resolutions',     help='Resolution profiles to report (defaults to all).', choices=sorted(RESOLUTION_PROFILES), nargs='+')
+    parser.add_argument('--repeat',          help='Predictions per latency measurement (defaults to 10).', default=10, type=int)
+
+    # the accuracy is only reported if a dataset is given
+    dataset = parser.add_mutually_exclusive_group()
+    dataset.add_argument('--coco',           help='Report mAP on this COCO dataset directory (ie. /tmp/COCO).', metavar='COCO_PATH')
+    dataset.add_argument('--pascal',         help='Report mAP on this Pascal VOC dataset directory (ie. /tmp/VOCdevkit).', metavar='PASCAL_PATH')
+    dataset.add_argument('--csv',            help='Report mAP on this CSV dataset (annotations and class mapping file).', nargs=2, metavar=('ANNOTATIONS', 'CLASSES'))
+    parser.add_argument('--score-threshold', help='Threshold on score to filter detections with (defaults to 0.05).', default=0.05, type=float)
+    parser.add_argument('--iou-threshold',   help='IoU Threshold to count for a positive detection (defaults to 0.5).', default=0.5, type=float)
+    parser.add_argument('--max-detections',  help='Max Detections per image (defaults to 100).', default=100, type=int)
+
+    return parser.parse_args(args)
+
+
+def create_report_generator(args):
+    """ The generator of the dataset given on the command line, None if no dataset was given. """
+    if args.coco:
+        dataset = argparse.Namespace(dataset_type='coco', coco_path=args.coco)
+    elif args.pascal:
+        dataset = argparse.Namespace(dataset_type='pascal', pascal_path=args.pascal)
+    elif args.csv:
+        dataset = argparse.Namespace(dataset_type='csv', annotations=args.csv[0], classes=args.csv[1])
+    else:
+        return None
+    return create_generator(dataset)
+
+
+def main(args=None):
+    # parse arguments
+    if args is None:
+        args = sys.argv[1:]
+    args = parse_args(args)
+
+    # make sure keras is the minimum required version
+    check_keras_version()
+
+    # the converted graph is meant for inference only
+    keras.backend.set_learning_phase(0)
+    keras.backend.tensorflow_backend.set_session(get_session())
+
+    # load the model
+    print('Loading model, this may take a second...')
+    model = keras.models.load_model(args.model, custom_objects=custom_objects)
+    if args.nms_classes:
+        model = retinanet_bbox_subset(model, args.nms_classes)
+
+    # convert and save it
+    graph_def = freeze(model, args.precision, classes=args.nms_classes, resolution=args.resolution)
+    with tf.gfile.GFile(args.output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Wrote {} ({:.1f} MB).'.format(args.output, os.path.getsize(args.output) / 2 ** 20))
+
+    # report accuracy and latency of the snapshot and the converted graph side by side
+    converted = FrozenGraphModel(args.output)
+    models    = [('keras float32', model), ('graph ' + args.precision, converted)]
+
+    generator = create_report_generator(args)
+    if generator is not None and args.nms_classes:
+        models = [(name, AllClasses(m, args.nms_classes, generator.num_classes())) for name, m in models]
+
+    for resolution_name in args.resolutions or sorted(RESOLUTION_PROFILES, key=lambda r: -RESOLUTION_PROFILES[r][0]):
+        min_side, max_side = RESOLUTION_PROFILES[resolution_name]
+        for name, m in models:
+            latency = measure_latency(m, (min_side, max_side), args.repeat)
+            line    = '{:7s} {:16s} {:8.1f} ms/frame'.format(resolution_name, name, latency * 1000)
+
+            if generator is not None:
+                generator.image_min_side, generator.image_max_side = min_side, max_side
+                average_precisions = evaluate(
+                    generator,
+                    m,
+                    iou_threshold=args.iou_threshold,
+                    score_threshold=args.score_threshold,
+                    max_detections=args.max_detections
+                )
+                labels = args.nms_classes or list(average_precisions.keys())
+                line  += '  mAP: {:.4f}'.format(sum(average_precisions[label] for label in labels) / len(labels))
+
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -89,6 +89,7 @@ def parse_args(args):
     parser.add_argument('--iou-threshold',   help='IoU Threshold to count for a positive detection (defaults to 0.5).', default=0.5, type=float)
     parser.add_argument('--max-detections',  help='Max Detections per image (defaults to 100).', default=100, type=int)
     parser.add_argument('--save-path',       help='Path for saving images with detections.')
+    parser.add_argument('--batch-size',      help='Number of images run through the network at once (defaults to 1).', default=1, type=int)
 
     return parser.parse_args(args)
 
@@ -128,7 +129,8 @@ def main(args=None):
         iou_threshold=args.iou_threshold,
         score_threshold=args.score_threshold,
         max_detections=args.max_detections,
-        save_path=args.save_path
+        save_path=args.save_path,
+        batch_size=args.batch_size
     )
 
     # print evaluation
@@ -76,21 +76,36 @@ class Anchors(keras.layers.Layer):
 
 
 class NonMaximumSuppression(keras.layers.Layer):
-    def __init__(self, nms_threshold=0.5, score_threshold=0.05, max_boxes=300, *args, **kwargs):
+    def __init__(self, nms_threshold=0.5, score_threshold=0.05, max_boxes=300, classes=None, *args, **kwargs):
+        """ Per class non maximum suppression of the classification scores.
+
+        Args
+            nms_threshold   : IoU above which the box with the lower score is suppressed.
+            score_threshold : Scores up to this value are set to 0.
+            max_boxes       : Maximum number of boxes kept per class.
+            classes         : List of class indices to keep, the output only contains their columns (in this order). None keeps all classes.
+        """
         self.nms_threshold   = nms_threshold
         self.score_threshold = score_threshold
         self.max_boxes       = max_boxes
+        self.classes         = classes
         super(NonMaximumSuppression, self).__init__(*args, **kwargs)
 
     def call(self, inputs, **kwargs):
-        # TODO: support batch size > 1.
-        boxes           = inputs[0][0]
-        classification  = inputs[1][0]
-        indices         = backend.range(keras.backend.shape(classification)[0])
+        # perform NMS for every image of the batch separately
+        boxes, classification = inputs
+        return backend.map_fn(
+            lambda args: self._filter_detections(args[0], args[1]),
+            elems=[boxes, classification],
+            dtype=keras.backend.floatx()
+        )
+
+    def _filter_detections(self, boxes, classification):
         selected_scores = []
+        classes         = self.classes if self.classes is not None else range(int(classification.shape[1]))
 
         # perform per class NMS
-        for c in range(int(classification.shape[1])):
+        for c in classes:
             scores = classification[:, c]
 
             # threshold based on score
@@ -113,11 +128,11 @@ class NonMaximumSuppression(keras.layers.Layer):
             selected_scores.append(scores)
 
         # reconstruct the (suppressed) classification scores
-        classification = keras.backend.concatenate(selected_scores, axis=1)
-
-        return keras.backend.expand_dims(classification, axis=0)
+        return keras.backend.concatenate(selected_scores, axis=1)
 
     def compute_output_shape(self, input_shape):
+        if self.classes is not None:
+            return tuple(input_shape[1][:2]) + (len(self.classes),)
         return input_shape[1]
 
     def get_config(self):
@@ -126,6 +141,7 @@ class NonMaximumSuppression(keras.layers.Layer):
             'nms_threshold'   : self.nms_threshold,
             'score_threshold' : self.score_threshold,
             'max_boxes'       : self.max_boxes,
+            'classes'         : self.classes,
         })
 
         return config
@@ -321,6 +321,7 @@ def retinanet_bbox(
     inputs,
     num_classes,
     nms        = True,
+    classes    = None,
     name       = 'retinanet-bbox',
     **kwargs
 ):
@@ -332,6 +333,8 @@ def retinanet_bbox(
     Args
         inputs      : keras.layers.Input (or list of) for the input to the model.
         num_classes : Number of classes to classify.
+        nms         : Whether to apply non maximum suppression to the classification.
+        classes     : List of class indices NMS is performed for and the NMS output contains, None for all classes.
         name        : Name of the model.
         *kwargs     : Additional kwargs to pass to the minimal retinanet model.
 
@@ -364,8 +367,32 @@ def retinanet_bbox(
 
     # optionally apply non maximum suppression
     if nms:
-        nms_classification  = layers.NonMaximumSuppression(name='nms')([boxes, classification])
+        nms_classification  = layers.NonMaximumSuppression(classes=classes, name='nms')([boxes, classification])
         outputs            += [nms_classification]
 
     # construct the model
     return keras.models.Model(inputs=inputs, outputs=outputs, name=name)
+
+
+def retinanet_bbox_subset(model, classes):
+    """ Rebuild the NMS of a loaded retinanet_bbox model so it only covers a subset of the classes.
+
+    The backbone and submodels are shared with the given model, only the final NMS layer is replaced.
+    NMS is the part of the prediction whose cost grows with the number of classes, so this is worthwhile
+    when only a few classes (e.g. person) are of interest.
+
+    Args
+        model   : A retinanet_bbox model with NMS (e.g. a snapshot loaded with keras.models.load_model).
+        classes : List of class indices to keep, column i of the new NMS output holds the scores of class classes[i].
+
+    Returns
+        A keras.models.Model with the same inputs and outputs as the given model, except for the NMS output.
+    """
+    nms    = model.get_layer('nms')
+    config = nms.get_config()
+    config['classes'] = list(classes)
+
+    boxes, classification = model.get_layer('clipped_boxes').output, model.get_layer('classification').output
+    nms_classification    = layers.NonMaximumSuppression.from_config(config)([boxes, classification])
+
+    return keras.models.Model(inputs=model.inputs, outputs=model.outputs[:-1] + [nms_classification], name=model.name)
@@ -17,6 +17,7 @@ limitations under the License.
 from __future__ import print_function
 
 from .anchors import compute_overlap
+from .image import pad_images
 from .visualization import draw_detections, draw_annotations
 
 import numpy as np
@@ -55,7 +56,7 @@ def _compute_ap(recall, precision):
     return ap
 
 
-def _get_detections(generator, model, score_threshold=0.05, max_detections=100, save_path=None):
+def _get_detections(generator, model, score_threshold=0.05, max_detections=100, save_path=None, batch_size=1):
     """ Get the detections from the model using the generator.
 
     The result is a list of lists such that the size is:
@@ -67,48 +68,57 @@ def _get_detections(generator, model, score_threshold=0.05, max_detections=100,
         score_threshold : The score confidence threshold to use.
         max_detections  : The maximum number of detections to use per image.
         save_path       : The path to save the images with visualized detections to.
+        batch_size      : The number of images run through the model at once, smaller images are zero padded.
     # Returns
         A list of lists containing the detections for each image in the generator.
     """
     all_detections = [[None for i in range(generator.num_classes())] for j in range(generator.size())]
 
-    for i in range(generator.size()):
-        raw_image    = generator.load_image(i)
-        image        = generator.preprocess_image(raw_image.copy())
-        image, scale = generator.resize_image(image)
+    for batch_start in range(0, generator.size(), batch_size):
+        image_indices = range(batch_start, min(batch_start + batch_size, generator.size()))
+        raw_images    = [generator.load_image(i) for i in image_indices]
+        images        = [generator.resize_image(generator.preprocess_image(raw_image.copy())) for raw_image in raw_images]
 
         # run network
-        _, _, boxes, nms_classification = model.predict_on_batch(np.expand_dims(image, axis=0))
+        _, _, batch_boxes, batch_classification = model.predict_on_batch(pad_images([image for image, _ in images]))
 
-        # correct boxes for image scale
-        boxes /= scale
+        for batch_index, i in enumerate(image_indices):
+            raw_image          = raw_images[batch_index]
+            image, scale       = images[batch_index]
+            nms_classification = batch_classification[batch_index]
 
-        # select indices which have a score above the threshold
-        indices = np.where(nms_classification[0, :, :] > score_threshold)
+            # keep boxes inside the image, the rest of the batch is padding, and correct them for image scale
+            boxes = batch_boxes[batch_index].copy()
+            boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, image.shape[1])
+            boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, image.shape[0])
+            boxes /= scale
 
-        # select those scores
-        scores = nms_classification[0][indices]
+            # select indices which have a score above the threshold
+            indices = np.where(nms_classification > score_threshold)
 
-        # find the order with which to sort the scores
-        scores_sort = np.argsort(-scores)[:max_detections]
+            # select those scores
+            scores = nms_classification[indices]
 
-        # select detections
-        image_boxes      = boxes[0, indices[0][scores_sort], :]
-        image_scores     = np.expand_dims(nms_classification[0, indices[0][scores_sort], indices[1][scores_sort]], axis=1)
-        image_detections = np.append(image_boxes, image_scores, axis=1)
-        image_predicted_labels = indices[1][scores_sort]
+            # find the order with which to sort the scores
+            scores_sort = np.argsort(-scores)[:max_detections]
 
-        if save_path is not None:
-            draw_annotations(raw_image, generator.load_annotations(i), generator=generator)
-            draw_detections(raw_image, boxes[0, indices[0][scores_sort], :], nms_classification[0, indices[0][scores_sort], :], generator=generator)
+            # select detections
+            image_boxes      = boxes[indices[0][scores_sort], :]
+            image_scores     = np.expand_dims(nms_classification[indices[0][scores_sort], indices[1][scores_sort]], axis=1)
+            image_detections = np.append(image_boxes, image_scores, axis=1)
+            image_predicted_labels = indices[1][scores_sort]
 
-            cv2.imwrite(os.path.join(save_path, '{}.png'.format(i)), raw_image)
+            if save_path is not None:
+                draw_annotations(raw_image, generator.load_annotations(i), generator=generator)
+                draw_detections(raw_image, boxes[indices[0][scores_sort], :], nms_classification[indices[0][scores_sort], :], generator=generator)
 
-        # copy detections to all_detections
-        for label in range(generator.num_classes()):
-            all_detections[i][label] = image_detections[image_predicted_labels == label, :]
+                cv2.imwrite(os.path.join(save_path, '{}.png'.format(i)), raw_image)
 
-        print('{}/{}'.format(i, generator.size()), end='\r')
+            # copy detections to all_detections
+            for label in range(generator.num_classes()):
+                all_detections[i][label] = image_detections[image_predicted_labels == label, :]
+
+            print('{}/{}'.format(i, generator.size()), end='\r')
 
     return all_detections
 
@@ -145,7 +155,8 @@ def evaluate(
     iou_threshold=0.5,
     score_threshold=0.05,
     max_detections=100,
-    save_path=None
+    save_path=None,
+    batch_size=1
 ):
     """ Evaluate a given dataset using a given model.
 
@@ -156,11 +167,12 @@ def evaluate(
         score_threshold : The score confidence threshold to use for detections.
         max_detections  : The maximum number of detections to use per image.
         save_path       : The path to save images with visualized detections to.
+        batch_size      : The number of images run through the model at once.
     # Returns
         A dict mapping class names to mAP scores.
     """
     # gather all detections and annotations
-    all_detections     = _get_detections(generator, model, score_threshold=score_threshold, max_detections=max_detections, save_path=save_path)
+    all_detections     = _get_detections(generator, model, score_threshold=score_threshold, max_detections=max_detections, save_path=save_path, batch_size=batch_size)
     all_annotations    = _get_annotations(generator)
     average_precisions = {}
 
@@ -0,0 +1,130 @@
+"""
+Copyright 2017-2018 Fizyr (https://fizyr.com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+
+import json
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+# This module runs graphs converted by keras_retinanet/bin/convert_model.py. It must not import keras
+# (directly or through other keras_retinanet modules), loading keras and building its layers is what
+# makes starting from a snapshot slow. The preprocessing therefore mirrors utils.image for float32,
+# channels last images.
+
+# name of the constant node convert_model.py stores the metadata of a converted graph in
+METADATA_NODE = 'retinanet_metadata'
+
+# (min_side, max_side) pairs for resize_image, smaller inputs trade accuracy for speed
+RESOLUTION_PROFILES = {
+    'full'   : (800, 1333),
+    'medium' : (608, 1013),
+    'small'  : (480, 800),
+    'tiny'   : (320, 533),
+}
+
+
+def preprocess_image(x):
+    """ Subtract the ImageNet mean from a BGR image, like utils.image.preprocess_image. """
+    x = x.astype(np.float32)
+    x[..., 0] -= 103.939
+    x[..., 1] -= 116.779
+    x[..., 2] -= 123.68
+    return x
+
+
+def resize_image(img, min_side=800, max_side=1333):
+    """ Resize an image like utils.image.resize_image, returns the resized image and the scale. """
+    (rows, cols, _) = img.shape
+    scale = min_side / min(rows, cols)
+    if max(rows, cols) * scale > max_side:
+        scale = max_side / max(rows, cols)
+    return cv2.resize(img, None, fx=scale, fy=scale), scale
+
+
+def pad_images(images):
+    """ Stack images of different sizes into one zero padded batch, like utils.image.pad_images. """
+    max_shape = tuple(max(image.shape[x] for image in images) for x in range(3))
+    batch     = np.zeros((len(images),) + max_shape, dtype=np.float32)
+    for image_index, image in enumerate(images):
+        batch[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+    return batch
+
+
+def add_metadata(graph_def, metadata):
+    """ Store a json serializable dict as a constant node in a graph, so the graph file describes itself. """
+    node = graph_def.node.add()
+    node.name = METADATA_NODE
+    node.op   = 'Const'
+    node.attr['dtype'].type = tf.string.as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(json.dumps(metadata)))
+    return graph_def
+
+
+def load_graph_def(path):
+    """ Read a serialized GraphDef from a .pb file. """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class FrozenGraphModel(object):
+    """ A frozen prediction graph written by keras_retinanet/bin/convert_model.py.
+
+    Offers the predict_on_batch method of the keras model it was converted from, so it can be used by
+    keras_retinanet.utils.eval.evaluate and in place of the keras model elsewhere. Building it only
+    imports tensorflow, no keras layers are constructed.
+    """
+
+    def __init__(self, path, session_config=None):
+        """ Load a frozen graph.
+
+        # Arguments
+            path           : Path to the .pb file.
+            session_config : Optional tf.ConfigProto for the session that runs the graph.
+        """
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(load_graph_def(path), name='')
+        self.session = tf.Session(graph=self.graph, config=session_config)
+
+        metadata      = self.session.run(self.graph.get_tensor_by_name(METADATA_NODE + ':0'))
+        self.metadata = json.loads(metadata.decode('utf-8'))
+        self.input    = self.graph.get_tensor_by_name(self.metadata['input'])
+        self.outputs  = [self.graph.get_tensor_by_name(name) for name in self.metadata['outputs']]
+
+    @property
+    def classes(self):
+        """ Class index of every column of the NMS output. """
+        return self.metadata['classes']
+
+    @property
+    def resolution(self):
+        """ Name of the resolution profile the graph was converted for. """
+        return self.metadata['resolution']
+
+    def predict_on_batch(self, images):
+        """ Run the graph on a batch of preprocessed images.
+
+        # Arguments
+            images : Array of shape (batch, rows, cols, 3).
+        # Returns
+            List of outputs in the order of the converted model (regression, classification, boxes, nms classification).
+        """
+        return self.session.run(self.outputs, feed_dict={self.input: images})
@@ -178,3 +178,21 @@ def resize_image(img, min_side=800, max_side=1333):
     img = cv2.resize(img, None, fx=scale, fy=scale)
 
     return img, scale
+
+
+def pad_images(images):
+    """ Stack images of different sizes into one batch.
+
+    Every image is copied to the upper left part of the batch, the rest is zero. Boxes predicted on
+    the batch are therefore in the coordinates of the original images.
+
+    # Arguments
+        images : List of images with shape (rows, cols, channels).
+    # Returns
+        Array of shape (len(images), max rows, max cols, channels).
+    """
+    max_shape = tuple(max(image.shape[x] for image in images) for x in range(3))
+    batch     = np.zeros((len(images),) + max_shape, dtype=keras.backend.floatx())
+    for image_index, image in enumerate(images):
+        batch[image_index, :image.shape[0], :image.shape[1], :image.shape[2]] = image
+    return batch
@@ -0,0 +1,64 @@
+from __future__ import print_function
+from __future__ import division
+
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_registry = {}
+
+
+class Stats(object):
+    """ running count, mean and maximum of a measured value, safe to update from several threads """
+
+    def __init__(self, name, unit="s"):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = None
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            self.last = value
+
+    @contextmanager
+    def time(self):
+        """ add the duration of the with block in seconds """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(time.time() - start)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def __str__(self):
+        if not self.count:
+            return "{}: -".format(self.name)
+        return "{}: last {:.3g}{u} mean {:.3g}{u} max {:.3g}{u} (n={})".format(
+            self.name, self.last, self.mean, self.max, self.count, u=self.unit)
+
+
+def get(name, unit="s"):
+    """ the Stats registered under name, created on first use """
+    with _lock:
+        if name not in _registry:
+            _registry[name] = Stats(name, unit)
+        return _registry[name]
+
+
+def report():
+    """ print all registered stats """
+    with _lock:
+        stats = sorted(_registry.values(), key=lambda s: s.name)
+    for s in stats:
+        print(s)
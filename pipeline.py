@@ -0,0 +1,128 @@
+from __future__ import print_function
+from __future__ import division
+
+import threading
+import traceback
+from collections import defaultdict
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# marks the end of the input for a worker thread
+_STOP = object()
+
+
+class _Job(object):
+    def __init__(self, item, key, seq):
+        self.item = item
+        self.key = key
+        self.seq = seq
+        self.value = item
+        self.error = None
+
+
+class Pipeline(object):
+    """ run items through a sequence of stages, each served by its own pool of worker threads
+
+    Stages are connected by bounded queues, so a slow stage (e.g. the classifier) applies back pressure on the
+    stages before it instead of piling up downloaded videos. A stage may return None to signal that the item
+    does not need to go through the remaining stages (e.g. no person was found).
+    Results are handed to the sink by a single thread in submission order per key (e.g. per camera), regardless
+    of which worker finished first.
+    """
+
+    def __init__(self, stages, sink, key=None, queue_size=4, done=None):
+        """
+        :param stages: list of (name, function, number of workers), each function maps the output of the
+                       previous stage to the input of the next one
+        :param sink: function(item, result) called for every submitted item whose stages all returned something
+        :param key: function(item) -> key, the sink sees items with the same key in the order they were submitted
+        :param queue_size: maximum number of items waiting in front of each stage
+        :param done: function(item) called for every submitted item once it has left the pipeline, after the sink
+                     and also if a stage returned None or failed
+        """
+        assert stages, "pipeline needs at least one stage"
+        self.stages = stages
+        self.sink = sink
+        self.key = key if key is not None else (lambda item: None)
+        self.done = done
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._done = queue.Queue(maxsize=queue_size)
+        self._next_seq = defaultdict(int)
+        self._submit_lock = threading.Lock()
+
+        self._workers = []
+        for n, (name, function, workers) in enumerate(stages):
+            threads = []
+            for w in range(workers):
+                t = threading.Thread(target=self._work, args=(n, function), name="{}-{}".format(name, w))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            self._workers.append(threads)
+        self._sink_thread = threading.Thread(target=self._drain, name="sink")
+        self._sink_thread.daemon = True
+        self._sink_thread.start()
+
+    def submit(self, item):
+        """ enqueue an item, blocks while the first stage is busy """
+        key = self.key(item)
+        with self._submit_lock:
+            seq = self._next_seq[key]
+            self._next_seq[key] += 1
+        self._queues[0].put(_Job(item, key, seq))
+
+    def close(self):
+        """ process everything that was submitted and stop all threads """
+        for n, threads in enumerate(self._workers):
+            for _ in threads:
+                self._queues[n].put(_STOP)
+            for t in threads:
+                t.join()
+        self._done.put(_STOP)
+        self._sink_thread.join()
+
+    def _work(self, n, function):
+        name = self.stages[n][0]
+        while True:
+            job = self._queues[n].get()
+            if job is _STOP:
+                return
+            try:
+                job.value = function(job.value)
+            except Exception as e:
+                print("stage", name, "failed for", job.key, ":", e)
+                traceback.print_exc()
+                job.error = e
+            if job.error is None and job.value is not None and n + 1 < len(self._queues):
+                self._queues[n + 1].put(job)
+            else:
+                self._done.put(job)
+
+    def _drain(self):
+        # jobs that finished early for a key are parked until all their predecessors are through
+        parked = defaultdict(dict)
+        expected = defaultdict(int)
+        while True:
+            job = self._done.get()
+            if job is _STOP:
+                return
+            parked[job.key][job.seq] = job
+            while expected[job.key] in parked[job.key]:
+                ready = parked[job.key].pop(expected[job.key])
+                expected[job.key] += 1
+                try:
+                    if ready.error is None and ready.value is not None:
+                        self.sink(ready.item, ready.value)
+                except Exception as e:
+                    print("sink failed for", ready.key, ":", e)
+                    traceback.print_exc()
+                if self.done is not None:
+                    try:
+                        self.done(ready.item)
+                    except Exception as e:
+                        print("done callback failed for", ready.key, ":", e)
+                        traceback.print_exc()
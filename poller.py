@@ -0,0 +1,66 @@
+from __future__ import print_function
+from __future__ import division
+
+import time
+from datetime import date, datetime, timedelta
+
+import metrics
+
+
+class LibraryPoller(object):
+    """ fetch the recordings that were added to the Arlo library since the last poll
+
+    The poller remembers the creation time of the newest recording it has seen (high-water mark) and only asks
+    for the days from there on. Cameras upload with some delay and long recordings finish uploading after
+    shorter ones that started later, so a recording may be older than the mark: the mark only picks the first
+    day (recordings up to grace seconds older are covered), the index filters out those processed already.
+    The interval between polls shrinks to min_interval as soon as something was recorded and grows by the
+    factor backoff up to max_interval while the cameras are idle.
+    """
+
+    def __init__(self, arlo, index, min_interval=3, max_interval=30, backoff=1.5, grace=900):
+        """
+        :param arlo: logged in Arlo object
+        :param index: RecordingIndex of the recordings that were processed already
+        :param min_interval: seconds between polls right after motion
+        :param max_interval: seconds between polls while the cameras are idle
+        :param backoff: factor the interval grows by after every poll without new recordings
+        :param grace: seconds a recording may be older than the high-water mark, the longest recording plus the
+                      upload delay
+        """
+        self.arlo = arlo
+        self.index = index
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.grace = grace
+        self.interval = min_interval
+        self.high_water_mark = index.newest()  # milliseconds like localCreatedDate, None if nothing seen yet
+        self.stats = metrics.get("library request")
+
+    def poll(self):
+        """ request the library and return the recordings that weren't processed yet, oldest first """
+        yesterday = date.today() - timedelta(days=1)
+        if self.high_water_mark is None:
+            first_day = yesterday
+        else:
+            # a day before yesterday would only return recordings the index has forgotten already
+            first_day = max(yesterday, datetime.fromtimestamp(self.high_water_mark / 1000 - self.grace).date())
+
+        with self.stats.time():
+            library = self.arlo.GetLibrary(first_day.strftime("%Y%m%d"), date.today().strftime("%Y%m%d"))
+
+        new = [recording for recording in library if recording not in self.index]
+        new.sort(key=lambda r: int(r['localCreatedDate']))
+
+        if new:
+            newest = int(new[-1]['localCreatedDate'])
+            self.high_water_mark = newest if self.high_water_mark is None else max(self.high_water_mark, newest)
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return new
+
+    def wait(self):
+        """ sleep until the next poll is due """
+        time.sleep(self.interval)
@@ -7,7 +7,7 @@ import os
 from server import getFrames, notify_client
 import detect
 import time
-import requests
+import sessions
 import shutil
 
 # pattern of links in notification mails
@@ -120,8 +120,8 @@ def getVideo(url, out_dir="videos"):
             return None
         print("saving video from", video_url, "at", out_path)
         driver.quit()
-    req = requests.get(video_url, stream=True)
-    with open(out_path, "wb") as f:
+    # closing the streamed response hands the connection back to the session's pool
+    with sessions.get_session().get(video_url, stream=True) as req, open(out_path, "wb") as f:
         assert req.status_code == 200
         shutil.copyfileobj(req.raw, f)
     return {"path": out_path, "url": video_url, "name": camera_name, "date": date}
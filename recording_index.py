@@ -0,0 +1,80 @@
+from __future__ import print_function
+from __future__ import division
+
+import sqlite3
+import threading
+import time
+
+
+def recording_key(recording):
+    """ identify a recording of the Arlo library """
+    return recording.get("uniqueId") or str(recording["localCreatedDate"])
+
+
+class RecordingIndex(object):
+    """ set of recordings that were already processed, kept across restarts
+
+    Lookups go to an in-memory dict, every added recording is committed to a sqlite database right away
+    (a crash can at most lose the recording that was being added, never corrupt the index).
+    Recordings that were started but not added yet (still in the pipeline) only count as known in memory,
+    so after a crash or restart they are processed again instead of being skipped.
+    Recordings older than max_age are forgotten, they have dropped out of the polled library by then.
+    The index may be used from several threads.
+    """
+
+    def __init__(self, path="processed.sqlite", max_age=3 * 24 * 3600):
+        """
+        :param path: location of the sqlite database, created if it doesn't exist yet
+        :param max_age: seconds after its creation a recording is removed from the index
+        """
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS processed (id TEXT PRIMARY KEY, created REAL NOT NULL)")
+        self._ids = {}
+        self._started = set()
+        self.expire()
+        self._ids = dict(self._db.execute("SELECT id, created FROM processed"))
+
+    def __contains__(self, recording):
+        key = recording_key(recording)
+        return key in self._ids or key in self._started
+
+    def __len__(self):
+        return len(self._ids)
+
+    def start(self, recording):
+        """ mark a recording as being processed, it is not persisted until add is called """
+        with self._lock:
+            self._started.add(recording_key(recording))
+
+    def add(self, recording):
+        """ mark a recording as processed """
+        key = recording_key(recording)
+        created = int(recording["localCreatedDate"]) / 1000  # Arlo reports milliseconds
+        with self._lock:
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO processed VALUES (?, ?)", (key, created))
+            self._ids[key] = created
+            self._started.discard(key)
+
+    def newest(self):
+        """ localCreatedDate (milliseconds) of the newest processed recording, None if the index is empty """
+        with self._lock:
+            if not self._ids:
+                return None
+            return int(round(max(self._ids.values()) * 1000))
+
+    def expire(self):
+        """ forget all processed recordings older than max_age """
+        oldest = time.time() - self.max_age
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM processed WHERE created < ?", (oldest,))
+            self._ids = {key: created for key, created in self._ids.items() if created >= oldest}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -3,18 +3,24 @@ from __future__ import print_function
 from __future__ import division
 
 import argparse
+import itertools
 import json
 import random
+import threading
 import time
 import os
 import requests
 import cv2
-import numpy as np
 from Arlo import Arlo
-from datetime import timedelta, date
-# import detect
-# import fasterrcnn
-import azure
+import metrics
+import sessions
+from cascade import create_cascade
+from pipeline import Pipeline
+from recording_index import RecordingIndex
+from tracker import Tracker
+from poller import LibraryPoller
+from video import getFrames, getFramesFromStream
+from oauth2client import transport
 from oauth2client.service_account import ServiceAccountCredentials
 
 # path to the firebase private key data used to authenticate at Google server
@@ -34,13 +40,56 @@ def main():
 
     parser.add_argument("--interval", help="timeinterval in seconds between email server is checked", default=5)
     parser.add_argument("--threshold", help="threshold when a change of a pixel grey value is consided a 'change'",
-                        default=20)
+                        type=int, default=20)
     parser.add_argument("--verbose", help="give more output", action="store_true")
     parser.add_argument("--test", help="image this is returned instead of a server request")
+    parser.add_argument("--download-workers", help="number of recordings downloaded and decoded in parallel",
+                        type=int, default=2)
+    parser.add_argument("--classify-workers", help="number of videos classified in parallel", type=int, default=2)
+    parser.add_argument("--keyframes", help="only analyze the keyframes of a recording", action="store_true")
+    parser.add_argument("--index", help="database of the recordings that were already processed",
+                        default="processed.sqlite")
+    parser.add_argument("--min-poll", help="seconds between library requests after motion", type=float, default=3)
+    parser.add_argument("--max-poll", help="seconds between library requests while cameras are idle",
+                        type=float, default=30)
+    parser.add_argument("--upload-grace", help="seconds a recording may be uploaded after a newer one, at least the "
+                                               "longest recording plus the upload delay", type=float, default=900)
+    parser.add_argument("--jpeg-quality", help="jpeg quality of frames uploaded to Azure", type=int, default=80)
+    parser.add_argument("--upload-size", help="longer side in pixels of frames uploaded to Azure", type=int,
+                        default=1024)
+    parser.add_argument("--azure-batch", help="frames of a recording classified by Azure at the same time", type=int,
+                        default=3)
+    parser.add_argument("--azure-lookahead", help="frames read ahead to send the ones with the most motion to Azure "
+                                                  "first", type=int, default=9)
+    parser.add_argument("--cascade", help="comma separated detectors a frame has to pass, cheap gates first "
+                                          "(motion, background, hog), the classifier last (azure, retinanet, hog)",
+                        default="motion,azure")
+    parser.add_argument("--state-dir", help="directory for state kept across restarts, e.g. background models",
+                        default="state")
+    parser.add_argument("--queue-size", help="recordings waiting in front of each stage", type=int, default=4)
+    parser.add_argument("--hog-profile", help="speed of the HOG people detector (accurate, balanced, fast)",
+                        default="accurate")
+    parser.add_argument("--hog-workers", help="frames of a recording the HOG classifier checks at the same time",
+                        type=int, default=1)
+    parser.add_argument("--retinanet-batch", help="frames of a recording RetinaNet classifies in one run", type=int,
+                        default=4)
+    parser.add_argument("--retinanet-model", help="RetinaNet snapshot (.h5) or graph converted with "
+                                                  "keras_retinanet/bin/convert_model.py (.pb)")
+    parser.add_argument("--retinanet-resolution", help="input size of RetinaNet (full, medium, small, tiny), "
+                                                       "defaults to the one a .pb model was converted for")
+    parser.add_argument("--retinanet-mode", help="what RetinaNet looks at: the full frame, tiles of it or the regions "
+                                                 "that changed since the previous frame (full, tiles, roi)",
+                        default="full")
+    parser.add_argument("--retinanet-crop-resolution", help="input size of every tile or region of RetinaNet",
+                        default="small")
+    parser.add_argument("--track-window", help="seconds a camera's recordings that start with a person who was "
+                                               "reported before still in view count as duplicates, 0 to report "
+                                               "every recording (needs a retinanet or hog classifier)",
+                        type=float, default=60)
     args = parser.parse_args()
 
     arlo = Arlo(j["arlo_user"], j["arlo_password"])
-    known_ids = []
+    processed = RecordingIndex(args.index)
     # if args.test:
     #     print("Test", args.test, "from cwd", os.getcwd(), "exists:", os.path.exists(args.test))
     #     frames = [cv2.imread(args.test)]
@@ -49,95 +98,99 @@ def main():
     #     analyze_frames_and_notify(frames, "http://dummy", recording, args.server, gui=args.gui)
     #     return
 
+    stages = args.cascade.split(",")
+    if stages[-1] == "azure":
+        classifier_kwargs = dict(quality=args.jpeg_quality, max_side=args.upload_size, batch_size=args.azure_batch,
+                                 lookahead=args.azure_lookahead)
+    elif stages[-1] == "hog":
+        classifier_kwargs = dict(gui=args.gui, profile=args.hog_profile, workers=args.hog_workers)
+    elif stages[-1] == "retinanet":
+        classifier_kwargs = dict(gui=args.gui, batch_size=args.retinanet_batch, resolution=args.retinanet_resolution,
+                                 mode=args.retinanet_mode, crop_resolution=args.retinanet_crop_resolution)
+        if args.retinanet_model:
+            classifier_kwargs["model_path"] = args.retinanet_model
+    else:
+        classifier_kwargs = dict(gui=args.gui)
+    classifier = create_cascade(stages, threshold=args.threshold, cameras=j.get("cameras"), state_dir=args.state_dir,
+                                hog_profile=args.hog_profile, **classifier_kwargs)
+    # recordings that show a person who was already reported are neither classified nor notified again
+    # only works with classifiers that locate the persons (retinanet, hog)
+    tracker = Tracker(window=args.track_window) if args.track_window > 0 else None
+
+    def download(recording):
+        # frames are decoded while the video is still downloading, the video never touches the disk
+        frames = getFramesFromStream(arlo.StreamRecording(recording['presignedContentUrl']),
+                                     keyframes=args.keyframes, lazy=True)
+        # wait until the first frame is there, the rest is decoded while the classifier works on it
+        first = next(frames, None)
+        if first is None:
+            return None
+        print('Streaming', recording['localCreatedDate'], "from Device", recording["deviceId"])
+        return recording["deviceId"], int(recording['localCreatedDate']) / 1000, first, frames
+
+    def classify(downloaded):
+        camera, created, first, frames = downloaded
+        try:
+            if tracker is not None and tracker.seen(camera, first, created):
+                print("skipping recording of", camera, "the person detected before is still there")
+                return None
+            person = classifier(itertools.chain([first], frames), camera)
+            if person is None:
+                return None
+            suspicious_frame, frame, boxes = person
+            if tracker is not None and boxes is not None:
+                tracker.add(camera, frame, boxes, created)
+            return suspicious_frame
+        finally:
+            # stops decoding (and downloading) the rest of the video once a person was found
+            frames.close()
+            if args.verbose:
+                metrics.report()
+
+    def notify(recording, suspicious_frame):
+        # print(args.silent, "suspicious frame", suspicious_frame)
+        if args.silent:
+            return
+        status, txt = notify_client(create_video_info(recording, suspicious_frame, path=None))
+        assert status == 200, "couldn't transmit picture. Error: " + str(txt)
+        print("notified client", status, ":", txt)
+
+    # download/decoding and classification of different recordings overlap,
+    # notifications of one camera are still sent in the order the recordings were made.
+    # a recording is only persisted as processed once it has left the pipeline, a restart processes the rest again
+    pipeline = Pipeline([("download", download, args.download_workers),
+                         ("classify", classify, args.classify_workers)],
+                        sink=notify, key=lambda recording: recording["deviceId"], queue_size=args.queue_size,
+                        done=processed.add)
+
+    if not args.silent:
+        get_access_token()  # fetch the FCM token now instead of delaying the first alert
+    if stages[-1] == "retinanet":
+        import fasterrcnn
+        # load and warm up the model before the first recording arrives
+        fasterrcnn.get_detector(args.retinanet_model or fasterrcnn.MODEL_PATH, args.retinanet_resolution)
+
+    poller = LibraryPoller(arlo, processed, min_interval=args.min_poll, max_interval=args.max_poll,
+                           grace=args.upload_grace)
     while True:
         start = time.time()
-        today = date.today().strftime("%Y%m%d")
-        yesterday = (date.today()-timedelta(days=1)).strftime("%Y%m%d")
         try:
-            library = arlo.GetLibrary(yesterday, today)
+            recordings = poller.poll()
         except requests.exceptions.HTTPError:
             print("somebody else logged in, stopping camera for 5 min")
             time.sleep(300)
             continue
-        print("library request took:", time.time()-start, "has:", len(library))
+        if args.verbose or recordings:
+            print(len(recordings), "new recordings,", poller.stats, ", next poll in {:.1f}s".format(poller.interval))
         with open("../static/arlo/lastactive.txt", "w") as f_:
             f_.write(str(start))
 
-        for recording in library:
-            video_id = str(recording['localCreatedDate'])
-            if video_id in known_ids:
-                continue
-            if len(known_ids) > 100:
-                known_ids.pop(0)
-            known_ids.append(video_id)
-
-            stream = arlo.StreamRecording(recording['presignedContentUrl'])
-            if not os.path.exists("videos"):
-                os.makedirs("videos/")
-            path = 'videos/' + video_id + ".mp4"
-            with open(path, 'wb') as f_:
-                for chunk in stream:
-                    f_.write(chunk)
-                f_.close()
-
-            print('Downloaded', path, "from Device", recording["deviceId"])
-
-            frames = getFrames(path)
-            # def analyze_frames_and_notify(frames, path, recording, server, gui=False):
-            # suspicious_frame = detect.hogDetector(frames, gui=args.gui)
-            # suspicious_frame = fasterrcnn.check_images(frames)
-            suspicious_frame = azure.check_images(frames)
-            # print(args.silent, "suspicious frame", suspicious_frame)
-            if suspicious_frame is not None and not args.silent:
-                status, txt = notify_client(create_video_info(recording, suspicious_frame, path=path))
-                assert status == 200, "couldn't transmit picture. Error: " + str(txt)
-                print("notified client", status, ":", txt)
-            os.remove(path)
-        time.sleep(10)
-
-
-def getFrames(path, interval=1):
-    """ extract some frames from a video
-
-    :param path: storage location of video
-    :param interval: a frame every interval seconds will be retrieved
-    :return: a list of length no_frames with ndarrays of frames with shape (frame_height, frame_width)
-    """
-
-    # known bug in OpenCV 3, can't do video caputure from file
-    # https://github.com/ContinuumIO/anaconda-issues/issues/121
-    if cv2.__version__.startswith("2."):
-        print("capturing video:", path)
-        cap = cv2.VideoCapture(path)
-        assert cap.isOpened(), "Couldn't open capture for " + path
-        frames_count = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-        try:
-            fps = int(round(cap.get(cv2.cv.CV_CAP_PROP_FPS), 0))
-        except ValueError:  # could not retrieve fps
-            fps = 24
-
-        def getFrame(frame_id):
-            success, f_ = cap.read(frame_id)
-            assert success, "could not capture frame " + str(frame_id * fps) + "\n" + str(frame_id)
-            return f_
-    else:
-        # this solution does not work on pythonanywhere as there is no imageio installed.
-        from imageio import get_reader
-        from skvideo.io import ffprobe
-
-        vid = get_reader(path, "ffmpeg")
-        videometadata = ffprobe(path)
-        rates = videometadata['video']['@avg_frame_rate'].split("/")
-        fps = int(rates[0]) // int(rates[1])
-        frames_count = np.int(videometadata['video']['@nb_frames'])
-
-        def getFrame(frame_id):
-            return vid.get_data(frame_id)
-
-    height, width, _ = getFrame(0).shape
-    rate = fps * interval  # every rate-th frame is extracted
-    no_frames = frames_count // rate  # so many frames will be extracted
-    return [getFrame(n * rate) for n in range(no_frames)]
+        # oldest first so alerts of one camera arrive in the order they were recorded
+        for recording in recordings:
+            processed.start(recording)
+            pipeline.submit(recording)
+        processed.expire()
+        poller.wait()
 
 
 def create_video_info(recording, suspicious_frame, path):
@@ -161,23 +214,90 @@ def create_video_info(recording, suspicious_frame, path):
     return video_info
 
 
-def notify_client(video_info):
-
-    def _get_access_token():
-        """Retrieve a valid access token that can be used to authorize requests.
+class AccessTokenCache(object):
+    """ hands out the access token for the FCM API and renews it in the background shortly before it expires,
+    so sending a notification doesn't have to wait for the token exchange with Google
+    """
 
-        :return: Access token.
+    def __init__(self, keyfile, scopes, margin=300):
         """
-        SCOPES = "https://www.googleapis.com/auth/firebase.messaging"
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            SERVICE_ACCOUNT_JSON, SCOPES)
-        access_token_info = credentials.get_access_token()
-        return access_token_info.access_token
+        :param keyfile: path to the service account json
+        :param scopes: scopes the token is requested for
+        :param margin: seconds before its expiry the token is renewed
+        """
+        self.credentials = ServiceAccountCredentials.from_json_keyfile_name(keyfile, scopes)
+        self.margin = margin
+        self._lock = threading.Lock()  # guards the token and the timer, never held during a token exchange
+        self._fetch_lock = threading.Lock()  # only one token exchange at a time
+        self._token = None
+        self._expires = 0
+        self._timer = None
+
+    def get(self):
+        """ a valid access token, only blocks if none was fetched yet or the background renewal failed """
+        with self._lock:
+            if self._token is not None and time.time() < self._expires:
+                return self._token
+        with self._fetch_lock:
+            # another thread may have fetched a token while this one was waiting
+            with self._lock:
+                if self._token is not None and time.time() < self._expires:
+                    return self._token
+            return self._refresh()
+
+    def _refresh(self):
+        # the caller holds _fetch_lock, readers only wait for the new token to be swapped in
+        # get_access_token() returns the credentials' own cached token until it is expired, force a new one
+        self.credentials.refresh(transport.get_http_object())
+        info = self.credentials.get_access_token()
+        expires = time.time() + (info.expires_in if info.expires_in is not None else 3600)
+        with self._lock:
+            self._token = info.access_token
+            self._expires = expires
+        self._schedule(max(expires - self.margin - time.time(), 0))
+        return info.access_token
+
+    def _schedule(self, delay):
+        # a single pending renewal, a new one replaces it
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._refresh_in_background)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            with self._fetch_lock:
+                self._refresh()
+        except Exception as e:
+            print("couldn't renew FCM access token, retrying in 30s:", e)
+            self._schedule(30)
+
+
+_access_tokens = None
+_access_tokens_lock = threading.Lock()
+
+
+def get_access_token():
+    """Retrieve a valid access token that can be used to authorize requests.
+
+    :return: Access token.
+    """
+    global _access_tokens
+    with _access_tokens_lock:
+        if _access_tokens is None:
+            SCOPES = "https://www.googleapis.com/auth/firebase.messaging"
+            _access_tokens = AccessTokenCache(SERVICE_ACCOUNT_JSON, SCOPES)
+    return _access_tokens.get()
+
+
+def notify_client(video_info):
 
     url = "https://fcm.googleapis.com/v1/projects/" + j["firebase_project_id"] + "/messages:send"
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer " + _get_access_token()
+        "Authorization": "Bearer " + get_access_token()
     }
     json_ = {
         "message": {
@@ -191,7 +311,7 @@ def notify_client(video_info):
             }
         }
     }
-    r = requests.post(url, headers=headers, json=json_)
+    r = sessions.get_session().post(url, headers=headers, json=json_)
     return r.status_code, r.text
 
 
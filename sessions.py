@@ -0,0 +1,58 @@
+from __future__ import print_function
+from __future__ import division
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout in seconds for requests that don't set their own
+DEFAULT_TIMEOUT = (5, 30)
+
+
+class TimeoutSession(requests.Session):
+    """ requests.Session that applies a default timeout, a bare session would wait forever """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+def create_session(pool_size=10, retries=3, backoff_factor=0.5, timeout=DEFAULT_TIMEOUT):
+    """ create a session that keeps connections alive and retries failed requests
+
+    Connections are pooled per host, so Azure, FCM and the video downloads each reuse their own
+    TCP/TLS connections instead of opening a new one per request.
+    Requests that couldn't connect are retried for every method, server errors (5xx) only for idempotent
+    methods so that e.g. a notification isn't sent twice. Waits between retries grow exponentially.
+
+    :param pool_size: connections kept open per host, should be at least the number of threads using the session
+    :param retries: how often a request is retried
+    :param backoff_factor: the n-th retry waits backoff_factor * 2^(n-1) seconds
+    :param timeout: (connect, read) timeout in seconds for requests that don't set their own
+    :return: TimeoutSession
+    """
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_size, max_retries=retry)
+    session = TimeoutSession(timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ the session shared by all outbound requests of this process """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
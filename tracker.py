@@ -0,0 +1,122 @@
+from __future__ import print_function
+from __future__ import division
+
+import threading
+import time
+import cv2
+import numpy as np
+
+import detect
+import metrics
+
+
+class Track(object):
+    """ the last sighting of a person on a camera: where (box in working resolution), when and how they looked """
+
+    def __init__(self, box, timestamp, patch, shape):
+        self.box = box
+        self.timestamp = timestamp
+        self.patch = patch
+        self.shape = shape
+
+
+class Tracker(object):
+    """ remembers the persons that were reported for every camera, to recognize when they are still there
+
+    As long as a person stays in view, the camera keeps uploading recordings of them. If a recording of a
+    camera starts with a person who was reported within the last window seconds still in view, it is a
+    duplicate: it needn't be classified and no notification is sent. The grey patch inside the box the
+    classifier found the person in is searched around the same place in the first frame of the recording
+    (normalized cross correlation, so a little movement and daylight changes don't matter). Only a match
+    of the person extends the track, a recording that starts on the empty scene is classified as usual.
+    Recordings of one camera that are classified at the same time may both be reported, a recording that
+    starts with the reported person and a second one coming in is skipped.
+    """
+
+    def __init__(self, window=60, similarity=0.7, margin=0.5, levels=2, min_size=8, min_contrast=4):
+        """
+        :param window: seconds after the last sighting a track is kept
+        :param similarity: minimum correlation (-1 to 1) of the person's patch with the frame to count as a match
+        :param margin: share of the box's width and height around it the person is searched in
+        :param levels: pyramid levels the frames are shrunk by, see detect.workingGray
+        :param min_size: minimum width and height of a box in working resolution pixels to be tracked
+        :param min_contrast: minimum standard deviation of the grey values of a patch, featureless patches
+                             (e.g. a dark silhouette at night) would match any plain area and are not tracked
+        """
+        self.window = window
+        self.similarity = similarity
+        self.margin = margin
+        self.levels = levels
+        self.min_size = min_size
+        self.min_contrast = min_contrast
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self.stats = metrics.get("tracker duplicates", unit="")
+
+    def seen(self, camera, frame, timestamp=None):
+        """ whether frame shows a person who was recently reported at about the same place, extends their track
+
+        :param camera: deviceId of the camera that recorded frame
+        :param frame: BGR frame, e.g. the first one of a recording
+        :param timestamp: time the frame was recorded in seconds, default now
+        :return: bool
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        gray = detect.workingGray(frame, self.levels)
+        with self._lock:
+            self._expire(camera, timestamp)
+            for track in self._tracks.get(camera, []):
+                box = self._match(track, gray)
+                if box is not None:
+                    # follow the person if they moved a little and slow changes like the daylight
+                    track.box = box
+                    track.patch = gray[box[1]:box[3], box[0]:box[2]]
+                    track.timestamp = max(track.timestamp, timestamp)
+                    self.stats.add(1.)
+                    return True
+        self.stats.add(0.)
+        return False
+
+    def add(self, camera, frame, boxes, timestamp=None):
+        """ remember the persons a classifier found on frame
+
+        :param camera: deviceId of the camera that recorded frame
+        :param frame: BGR frame the persons were found on, at the resolution of the frames later passed to seen
+        :param boxes: (N, 4) array of [x1, y1, x2, y2] of the persons in frame coordinates
+        :param timestamp: time the frame was recorded in seconds, default now
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        gray = detect.workingGray(frame, self.levels)
+        height, width = gray.shape
+        boxes = np.round(np.asarray(boxes, dtype=float).reshape(-1, 4) / 2 ** self.levels).astype(int)
+        boxes = np.clip(boxes, 0, [width, height, width, height])
+
+        tracks = []
+        for box in boxes:
+            patch = gray[box[1]:box[3], box[0]:box[2]]
+            if min(patch.shape) < self.min_size or patch.std() < self.min_contrast:
+                continue
+            tracks.append(Track(box, timestamp, patch, gray.shape))
+        with self._lock:
+            self._expire(camera, timestamp)
+            self._tracks.setdefault(camera, []).extend(tracks)
+
+    def _match(self, track, gray):
+        """ box of the best match of the track's patch around its last place, None if there is none """
+        if track.shape != gray.shape:
+            return None
+        height, width = gray.shape
+        box = track.box
+        grow = np.round((box[2:] - box[:2]) * self.margin).astype(int)
+        x1, y1 = np.maximum(box[:2] - grow, 0)
+        x2, y2 = np.minimum(box[2:] + grow, [width, height])
+        correlation = cv2.matchTemplate(gray[y1:y2, x1:x2], track.patch, cv2.TM_CCOEFF_NORMED)
+        _, best, _, (x, y) = cv2.minMaxLoc(correlation)
+        if not best >= self.similarity:  # also rejects nan of a plain search area
+            return None
+        patch_height, patch_width = track.patch.shape
+        return np.array([x1 + x, y1 + y, x1 + x + patch_width, y1 + y + patch_height])
+
+    def _expire(self, camera, now):
+        self._tracks[camera] = [track for track in self._tracks.get(camera, [])
+                                if track.timestamp > now - self.window]
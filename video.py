@@ -0,0 +1,198 @@
+from __future__ import print_function
+from __future__ import division
+
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import cv2
+import numpy as np
+
+# ffmpeg executable used to decode videos that are not read through OpenCV
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+
+def getFrames(path, interval=1, sampling="decode", lazy=False):
+    """ extract some frames from a video
+
+    :param path: storage location of video
+    :param interval: a frame every interval seconds will be retrieved
+    :param sampling: "decode": decode the video from the start up to every extracted frame,
+                     "seek": a single ffmpeg run decodes the video and only hands over the extracted frames
+                     (with OpenCV 2 the capture jumps to every extracted frame instead),
+                     "keyframes": only decode the keyframes of the video, interval is ignored
+    :param lazy: return a generator that only decodes a frame when it is requested,
+                 so a consumer that stops early (e.g. a detector that found a person) saves the rest of the work
+    :return: a list (generator if lazy) of length no_frames with ndarrays of frames with shape (frame_height, frame_width)
+    """
+    assert sampling in ("decode", "seek", "keyframes"), "unknown sampling " + str(sampling)
+    if sampling == "keyframes":
+        # the decoder skips all frames that depend on other frames, so only a fraction is decoded at all
+        frames = _ffmpeg_frames(["-skip_frame", "nokey", "-i", path], ["-vsync", "0"])
+        return frames if lazy else list(frames)
+
+    # known bug in OpenCV 3, can't do video caputure from file
+    # https://github.com/ContinuumIO/anaconda-issues/issues/121
+    if cv2.__version__.startswith("2."):
+        print("capturing video:", path)
+        cap = cv2.VideoCapture(path)
+        assert cap.isOpened(), "Couldn't open capture for " + path
+        frames_count = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
+        try:
+            fps = int(round(cap.get(cv2.cv.CV_CAP_PROP_FPS), 0))
+        except ValueError:  # could not retrieve fps
+            fps = 24
+
+        def getFrame(frame_id):
+            if sampling == "seek":
+                # read() ignores its argument and returns the next frame, position the capture explicitly
+                cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, frame_id)
+            success, f_ = cap.read(frame_id)
+            assert success, "could not capture frame " + str(frame_id * fps) + "\n" + str(frame_id)
+            return f_
+    else:
+        # this solution does not work on pythonanywhere as there is no imageio installed.
+        from imageio import get_reader
+        from skvideo.io import ffprobe
+
+        vid = get_reader(path, "ffmpeg") if sampling == "decode" else None
+        videometadata = ffprobe(path)
+        rates = videometadata['video']['@avg_frame_rate'].split("/")
+        fps = int(rates[0]) // int(rates[1])
+        frames_count = int(videometadata['video']['@nb_frames'])
+
+        if sampling == "seek":
+            getFrame = None  # all frames are extracted in a single ffmpeg run, see below
+        else:
+            def getFrame(frame_id):
+                return vid.get_data(frame_id)
+
+    rate = fps * interval  # every rate-th frame is extracted
+    no_frames = frames_count // rate  # so many frames will be extracted
+    if getFrame is None:
+        # one process for all frames: seeking with a process per frame pays the startup and decodes up to a
+        # keyframe interval for every frame, the select filter drops the other frames before they are converted
+        frames = _ffmpeg_frames(["-i", path], ["-vf", "select=not(mod(n\\,{}))".format(rate), "-vsync", "0",
+                                               "-frames:v", str(no_frames)])
+    else:
+        frames = (getFrame(n * rate) for n in range(no_frames))
+    return frames if lazy else list(frames)
+
+
+def getFramesFromStream(chunks, interval=1, keyframes=False, lazy=False):
+    """ extract some frames from a video while it is being downloaded, without storing it on disk
+
+    The chunks are piped into ffmpeg as they arrive, so decoding runs alongside the download.
+    ffmpeg can only decode an mp4 from a pipe if its index (moov atom) comes before the video data,
+    otherwise the received bytes are written to a temporary file and decoded from there.
+
+    :param chunks: iterable of bytes, e.g. the generator returned by Arlo.StreamRecording
+    :param interval: a frame every interval seconds will be retrieved
+    :param keyframes: only decode the keyframes of the video, interval is ignored
+    :param lazy: return a generator that yields every frame as soon as it is decoded,
+                 closing it stops the decoder and the download
+    :return: a list (generator if lazy) with ndarrays of BGR frames with shape (frame_height, frame_width, 3)
+    """
+    frames = _stream_frames(iter(chunks), interval, keyframes)
+    return frames if lazy else list(frames)
+
+
+def _stream_frames(chunks, interval, keyframes):
+    # the received bytes are only needed for the fallback, which is only taken if no frame could be decoded,
+    # they are dropped with the first frame instead of keeping the whole video in memory
+    received = []
+    buffering = [True]
+    lock = threading.Lock()
+
+    def tee():
+        for chunk in chunks:
+            with lock:
+                if buffering[0]:
+                    received.append(chunk)
+            yield chunk
+
+    if keyframes:
+        input_args, output_args = ["-skip_frame", "nokey"], ["-vsync", "0"]
+    else:
+        input_args, output_args = [], ["-vf", "fps=1/{}".format(interval)]
+
+    decoded = 0
+    try:
+        for frame in _ffmpeg_frames(input_args + ["-i", "pipe:0"], output_args, stdin=tee()):
+            if not decoded:
+                with lock:
+                    buffering[0] = False
+                    del received[:]
+            decoded += 1
+            yield frame
+    except IOError as e:
+        if decoded:
+            raise
+        print("could not decode stream (", e, "), decoding from temporary file")
+        with tempfile.NamedTemporaryFile(suffix=".mp4") as f_:
+            with lock:
+                buffering[0] = False
+                for chunk in received:
+                    f_.write(chunk)
+                del received[:]
+            for chunk in chunks:  # in case ffmpeg gave up before the download was complete
+                f_.write(chunk)
+            f_.flush()
+            for frame in _ffmpeg_frames(input_args + ["-i", f_.name], output_args):
+                yield frame
+
+
+def _ffmpeg_frames(input_args, output_args=(), stdin=None):
+    """ run ffmpeg and yield the decoded frames one by one as soon as they are available
+
+    :param input_args: ffmpeg arguments up to and including the input ("-i", ...)
+    :param output_args: ffmpeg arguments applied to the output, e.g. filters
+    :param stdin: optional iterable of bytes that is fed to ffmpeg's stdin ("-i pipe:0")
+    :return: generator of BGR ndarrays
+    """
+    cmd = [FFMPEG_BINARY, "-loglevel", "error"] + list(input_args) + list(output_args) + \
+          ["-f", "image2pipe", "-vcodec", "bmp", "pipe:1"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+    threads = [threading.Thread(target=lambda: errors.append(proc.stderr.read()))]
+    if stdin is not None:
+        threads.append(threading.Thread(target=_feed, args=(proc.stdin, stdin)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        while True:
+            # ffmpeg writes one bmp file after the other, the header tells how long each of them is
+            header = proc.stdout.read(14)
+            if len(header) < 14:
+                break
+            size = struct.unpack("<I", header[2:6])[0]
+            data = header + proc.stdout.read(size - 14)
+            yield cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        proc.wait()
+        for t in threads:
+            t.join()
+        if proc.returncode != 0:
+            raise IOError("ffmpeg failed: " + b"".join(errors).decode("utf-8", "replace").strip())
+    finally:
+        if proc.poll() is None:
+            # the consumer stopped early, no need to decode the rest
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+def _feed(pipe, chunks):
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+    except (IOError, OSError):
+        pass  # ffmpeg exited (error or killed), it doesn't need more input
+    finally:
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass